@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import json
+import math
+import time
+
+import serial
+
+import kw1
+import Viessmann2MQTT as v2m
+import VS2Protocol as vs2
+from OptolinkAsync import AsyncSerial, AsyncVS1Session, AsyncVS2Session
+from OptolinkSimulator import SimulatedSerial, VitotronicSimulator, byteTime
+from VS2Poller import planReads
+
+# Runs poll cycles of the readCmds from Viessmann2MQTT.py (VS2) and of the stat_commands from kw1.py
+# (VS1), merged and with one request per datapoint, on the asyncio engine of both scripts against
+# the OptolinkSimulator or a real link and reports cycle time, round trip latencies per address,
+# retries, bytes on the wire and the link utilization. The results are written as JSON, so runs
+# before and after a change can be compared:
+#
+#   python3 BenchmarkPollCycle.py --cycles 3 --output before.json
+
+HISTOGRAM_BUCKETS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0] # upper bounds in seconds
+
+class CountingPort():
+    # counts the bytes on the wire in both directions
+    def __init__(self, ser):
+        self.ser = ser
+        self.txBytes = 0
+        self.rxBytes = 0
+
+    def write(self, data):
+        self.txBytes += len(data)
+        return self.ser.write(data)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        self.rxBytes += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        if name in ('timeout', 'inter_byte_timeout'):
+            setattr(self.ser, name, value)
+        else:
+            super().__setattr__(name, value)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)]
+
+def histogram(values):
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for value in values:
+        counts[next((i for i, bound in enumerate(HISTOGRAM_BUCKETS) if value <= bound), len(HISTOGRAM_BUCKETS))] += 1
+    return {('le_%g' % bound if i < len(HISTOGRAM_BUCKETS) else 'inf'): count for i, (bound, count) in enumerate(zip(HISTOGRAM_BUCKETS + [None], counts))}
+
+def latencyStats(values):
+    if not values:
+        return {'count': 0}
+    return {'count': len(values), 'p50': percentile(values, 50), 'p90': percentile(values, 90), 'p99': percentile(values, 99), 'max': max(values)}
+
+class Run():
+    def __init__(self, name, port):
+        self.name = name
+        self.port = port
+        self.cycles = []
+        self.latencies = {} # address: [round trip times]
+
+    async def cycle(self, requests):
+        # requests is a list of (address, coroutine function returning True on success, False to retry)
+        txBytes, rxBytes = self.port.txBytes, self.port.rxBytes
+        retries = failed = 0
+        start = time.monotonic()
+        for addr, request in requests:
+            for attempt in range(5): # 5 tries like the poll loops
+                if attempt:
+                    retries += 1
+                t = time.monotonic()
+                if await request():
+                    self.latencies.setdefault('0x%04x' % addr, []).append(time.monotonic() - t)
+                    break
+            else:
+                failed += 1
+        duration = time.monotonic() - start
+        wire = self.port.txBytes - txBytes + self.port.rxBytes - rxBytes
+        self.cycles.append({'duration': duration, 'requests': len(requests), 'retries': retries, 'failed': failed,
+                            'txBytes': self.port.txBytes - txBytes, 'rxBytes': self.port.rxBytes - rxBytes,
+                            'utilization': wire * byteTime() / duration if duration else 0})
+
+    def result(self):
+        allLatencies = [t for values in self.latencies.values() for t in values]
+        return {'name': self.name, 'cycles': self.cycles,
+                'cycleTime': latencyStats([cycle['duration'] for cycle in self.cycles]),
+                'latency': latencyStats(allLatencies), 'histogram': histogram(allLatencies),
+                'addresses': {addr: latencyStats(values) for addr, values in sorted(self.latencies.items())}}
+
+def vs2Requests(session, blocks):
+    def request(block):
+        msg = vs2.requestMessage(block.fc, block.addr, block.size)
+        async def send():
+            return await session.send(msg) is not None
+        return send
+    return [(block.addr, request(block)) for block in blocks]
+
+async def runVS2(port, cycles, merged):
+    run = Run('vs2-merged' if merged else 'vs2-single', port)
+    session = AsyncVS2Session(AsyncSerial(port))
+    if not await session.start():
+        raise RuntimeError('VS2 handshake failed')
+    # the datapoints as Viessmann2MQTT.py polls them: with ERROR_HISTORY only the newest entry of every
+    # error history, so vs2-single is one request per datapoint, not per readCmds entry
+    datapoints = v2m.compileDatapoints(v2m.readCmds)
+    blocks = planReads(datapoints, maxBlockSize=v2m.MAX_BLOCK_SIZE, maxGap=v2m.MAX_BLOCK_GAP) if merged else planReads(datapoints, maxBlockSize=0)
+    for _ in range(cycles):
+        await run.cycle(vs2Requests(session, blocks))
+    return run
+
+async def runVS1(port, cycles, merged):
+    run = Run('vs1-merged' if merged else 'vs1-single', port)
+    session = AsyncVS1Session(AsyncSerial(port))
+    def request(block):
+        async def read():
+            return await kw1.readBlock(session, block)
+        return read
+    blocks = kw1.planReads(kw1.stat_commands) if merged else kw1.planReads(kw1.stat_commands, maxLength=0)
+    if not await session.sync():
+        raise RuntimeError('no ENQ received')
+    for _ in range(cycles): # the session stays open, like in kw1.py
+        await run.cycle([(block.addr, request(block)) for block in blocks])
+    return run
+
+def openPort(args, protocols):
+    if args.port:
+        ser = serial.serial_for_url(args.port, baudrate=4800, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_TWO, bytesize=serial.EIGHTBITS)
+        return CountingPort(ser), None
+    simulator = VitotronicSimulator(protocols=protocols, nackRate=args.nack, checksumErrorRate=args.checksum, dropRate=args.drop, seed=args.seed)
+    return CountingPort(SimulatedSerial(simulator)), simulator
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the poll cycles of Viessmann2MQTT.py and kw1.py')
+    parser.add_argument('--cycles', type=int, default=3, help='cycles per run')
+    parser.add_argument('--runs', default='vs2-merged,vs2-single,vs1-merged,vs1-single', help='comma separated list of vs2-merged, vs2-single, vs1-merged and vs1-single')
+    parser.add_argument('--port', default=None, help='serial port or URL of a real link, the simulator is used otherwise')
+    parser.add_argument('--nack', type=float, default=0, help='simulator: probability of a NACK for a VS2 request')
+    parser.add_argument('--checksum', type=float, default=0, help='simulator: probability of a corrupted reply')
+    parser.add_argument('--drop', type=float, default=0, help='simulator: probability to drop a reply byte')
+    parser.add_argument('--seed', type=int, default=1, help='simulator: seed for the fault injection')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    args = parser.parse_args()
+
+    results = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': vars(args), 'runs': []}
+    for name in args.runs.split(','):
+        port, simulator = openPort(args, ('VS1',) if name.startswith('vs1') else ('VS1', 'VS2'))
+        if name.startswith('vs1'):
+            run = asyncio.run(runVS1(port, args.cycles, name == 'vs1-merged'))
+        else:
+            run = asyncio.run(runVS2(port, args.cycles, name == 'vs2-merged'))
+        result = run.result()
+        if simulator:
+            result['simulator'] = dict(simulator.stats)
+        results['runs'].append(result)
+        port.close()
+        print('%-10s cycle %.2fs (p50), latency p50 %.1fms p99 %.1fms, %d requests, %d retries, %d failed, %d bytes, %.0f%% link utilization' % (
+            name, result['cycleTime']['p50'], result['latency']['p50'] * 1000, result['latency']['p99'] * 1000,
+            sum(c['requests'] for c in run.cycles), sum(c['retries'] for c in run.cycles), sum(c['failed'] for c in run.cycles),
+            sum(c['txBytes'] + c['rxBytes'] for c in run.cycles), 100 * sum(c['utilization'] for c in run.cycles) / len(run.cycles)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
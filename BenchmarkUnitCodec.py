@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import binascii
+import timeit
+
+import kw1
+from OptolinkSimulator import VitotronicSimulator
+
+# Microbenchmark of the conversion of the values read by kw1.py for every unit of the stat_commands:
+# the former convertunit(), a chain of string comparisons, which unhexlified the operating modes for
+# every comparison, against the decoders of UNIT_CODECS, which readBlock() calls through the commands.
+# The values are the ones of the simulator.
+
+def legacyConvertunit(unit, value):
+    # convertunit before UNIT_CODECS
+    if unit == 'deviceType':
+        if value == binascii.unhexlify('2094'):
+            return 'V200 KW1'
+    if unit == 'UT':
+        return int.from_bytes(value, "little", signed=True) / 10
+    if unit == 'ST':
+        return int.from_bytes(value, "little")
+    if unit == 'RT':
+        return int.from_bytes(value, "little")
+    if unit == 'CO':
+        return int.from_bytes(value, "little")
+    if unit == 'CS':
+        return int.from_bytes(value, "little") / 3600
+    if unit == 'BA':
+        if value == binascii.unhexlify('00'):
+            return 'Warm Wasser'
+        if value == binascii.unhexlify('01'):
+            return 'Reduziert'
+        if value == binascii.unhexlify('02'):
+            return 'Normal'
+        if value == binascii.unhexlify('03'):
+            return 'Heizung und Warm Wasser'
+        if value == binascii.unhexlify('04'):
+            return 'Heizung und Warmwasser'
+        if value == binascii.unhexlify('05'):
+            return 'Abgeschaltet'
+    return 'error'
+
+def samples():
+    # (command, bytes) of every stat_command, with the device type added
+    memory = VitotronicSimulator().memory
+    commands = [kw1.Command("deviceType", kw1.CMD_VREAD, '00F8', 2, 'deviceType', 'Geraet')] + kw1.stat_commands
+    return [(cmd, bytes(memory[cmd.addr:cmd.addr + cmd.length])) for cmd in commands]
+
+def chainSweep(values):
+    for cmd, value in values:
+        cmd.res = legacyConvertunit(cmd.unit, value)
+
+def codecSweep(values):
+    # like readBlock()
+    for cmd, value in values:
+        result = cmd.decode(value)
+        cmd.res = kw1.ConversionError(cmd.unit, value) if result is None else result
+
+def best(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+def main():
+    parser = argparse.ArgumentParser(description='Time per conversion of the kw1.py units')
+    parser.add_argument('--number', type=int, default=100000, help='number of conversions per unit')
+    args = parser.parse_args()
+
+    values = samples()
+    for cmd, value in values:
+        if legacyConvertunit(cmd.unit, value) != kw1.convertunit(cmd.unit, value):
+            raise RuntimeError('%s %s: %r instead of %r' % (cmd.name, value.hex(), kw1.convertunit(cmd.unit, value), legacyConvertunit(cmd.unit, value)))
+    units = {}
+    for cmd, value in values:
+        units.setdefault(cmd.unit, [(cmd, value)] * 10)
+    for unit, unitValues in units.items():
+        legacy = best(lambda: chainSweep(unitValues), args.number // 10) / 10
+        codec = best(lambda: codecSweep(unitValues), args.number // 10) / 10
+        print('%-10s %-10s chain %6.0fns, codec %6.0fns' % (unit, unitValues[0][1].hex(), legacy * 1e9, codec * 1e9))
+    legacy = best(lambda: chainSweep(values), args.number // 10)
+    codec = best(lambda: codecSweep(values), args.number // 10)
+    print('%d conversions per sweep: chain %.1fus, codec %.1fus' % (len(values), legacy * 1e6, codec * 1e6))
+
+if __name__ == '__main__':
+    main()
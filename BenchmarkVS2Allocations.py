@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import timeit
+import tracemalloc
+
+import Viessmann2MQTT as v2m
+import VS2Protocol as vs2
+from VS2Poller import planReads
+
+# Microbenchmark of the per cycle work for building the requests and parsing the replies of
+# all read blocks of Viessmann2MQTT.py: the former VS2Message, which built every request again
+# and copied the reply data, against the cached requests and the zero-copy parsing.
+
+class LegacyVS2Message():
+    # VS2Message before the request cache and __slots__
+    protocol = vs2.ProtocolIdentifier.LDAP
+    identifier = vs2.MessageIdentifier.RequestMessage
+    Command = vs2.FunctionCodes.undefined
+    ADDR = 0
+    Data = bytes()
+    msgBytes = bytes()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) == 1:
+            self.msgBytes = args[0]
+            self.protocol = vs2.ProtocolIdentifier(self.msgBytes[0] & 0xF0)
+            self.identifier = vs2.MessageIdentifier(self.msgBytes[0] & 0x0F)
+            self.Command = vs2.FunctionCodes(self.msgBytes[1])
+            self.ADDR = (self.msgBytes[2] << 8) + self.msgBytes[3]
+            self.BlockSize = self.msgBytes[4]
+            self.Data = self.msgBytes[5:]
+        else:
+            self.protocol = args[0]
+            self.identifier = args[1]
+            self.Command = args[2]
+            self.ADDR = args[3]
+            self.BlockSize = args[4]
+            if len(args) > 5:
+                self.Data = args[5]
+            else:
+                self.Data = None
+            buf = bytearray([self.protocol.value | self.identifier.value, self.Command.value, self.ADDR >> 8, self.ADDR & 0xFF, self.BlockSize])
+            if self.Data:
+                buf += bytearray(self.Data)
+            buf = bytearray([0x41, len(buf)]) + buf
+            buf = buf + bytearray([sum(buf[1:]) & 0xFF])
+            self.msgBytes = bytes(buf)
+
+def replies(plan):
+    # the reply frames of all blocks, back-to-back in one buffer like in the VS2FrameDecoder
+    buf = bytearray()
+    offsets = []
+    for block in plan:
+        reply = vs2.VS2Message(vs2.ProtocolIdentifier.LDAP, vs2.MessageIdentifier.ResponseMessage, block.fc, block.addr, block.size, bytes(block.size))
+        offsets.append((len(buf), len(reply.msgBytes)))
+        buf += reply.msgBytes
+    return buf, offsets
+
+def legacyCycle(plan, buf, offsets):
+    result = []
+    for block, (start, size) in zip(plan, offsets):
+        request = LegacyVS2Message(vs2.ProtocolIdentifier.LDAP, vs2.MessageIdentifier.RequestMessage, block.fc, block.addr, block.size)
+        response = LegacyVS2Message(bytes(buf[start + 2:start + size - 1]))
+        result.append((request, response))
+    return result
+
+def cachedCycle(plan, buf, offsets):
+    result = []
+    view = memoryview(buf)
+    for block, (start, size) in zip(plan, offsets):
+        request = vs2.requestMessage(block.fc, block.addr, block.size)
+        response = vs2.VS2Message(view[start + 2:start + size - 1])
+        result.append((request, response))
+    return result
+
+def allocations(cycle, args):
+    # memory blocks and bytes allocated by one cycle, the messages are kept like the poll loop does till the values are published
+    cycle(*args) # warm up, fills the request cache
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = cycle(*args)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    del result
+    return sum(stat.count_diff for stat in stats), sum(stat.size_diff for stat in stats)
+
+def main():
+    parser = argparse.ArgumentParser(description='Allocations and time per cycle for building the VS2 requests and parsing the replies')
+    parser.add_argument('--number', type=int, default=1000, help='number of cycles for the timing')
+    args = parser.parse_args()
+
+    plan = planReads(v2m.compileDatapoints(v2m.readCmds))
+    buf, offsets = replies(plan)
+    for name, cycle in [('rebuilt + copied', legacyCycle), ('cached + zero-copy', cachedCycle)]:
+        blocks, size = allocations(cycle, (plan, buf, offsets))
+        duration = timeit.timeit(lambda: cycle(plan, buf, offsets), number=args.number) / args.number
+        print('%-19s %d requests per cycle: %5d allocated blocks, %6d bytes, %.1fus' % (name, len(plan), blocks, size, duration * 1e6))
+
+if __name__ == '__main__':
+    main()
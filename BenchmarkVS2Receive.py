@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import binascii
+import time
+
+import Viessmann2MQTT as v2m
+import VS2Protocol as vs2
+from OptolinkSimulator import SimulatedSerial
+
+# Compares the cycle time for reading all readCmds of Viessmann2MQTT.py with the old
+# 100ms polling receive path and the new deadline based receive path.
+# The heating unit is replaced by the OptolinkSimulator with the 4800 8E2 byte timing.
+
+def legacySendVS2Message(ser, message):
+    # the receive path before the change: check in_waiting, then sleep 100ms
+    ser.write(message.msgBytes)
+    t = 0
+    buf = None
+    receiveStatus = vs2.ReceiveState.unknown
+    while t < 3000:
+        if ser.in_waiting:
+            if buf == None:
+                buf = ser.read(ser.in_waiting)
+            else:
+                buf += ser.read(ser.in_waiting)
+            if len(buf):
+                if buf[0] == 0x06: # VS2_ACK
+                    receiveStatus = vs2.ReceiveState.ACK
+                elif buf[0] == 0x15: # VS2_NACK
+                    receiveStatus = vs2.ReceiveState.NACK
+                if len(buf) > 1:
+                    if receiveStatus != vs2.ReceiveState.ACK and receiveStatus != vs2.ReceiveState.NACK:
+                        break # unknown state
+                    if len(buf) > 3 and buf[1] == 0x41 and len(buf) == 1 + buf[2] + 3 and (sum(buf[2:-1]) & 0xff) == buf[-1]:
+                        ser.write(binascii.unhexlify('06')) # VS2_ACK
+                        return vs2.VS2Message(buf[3:-1])
+        time.sleep(0.1)
+        t += 100
+    return None
+
+def runCycle(ser, send):
+    failed = 0
+    start = time.monotonic()
+    for cmd in v2m.readCmds:
+        msg = vs2.VS2Message(vs2.ProtocolIdentifier.LDAP, vs2.MessageIdentifier.RequestMessage, vs2.FunctionCodes.Virtual_READ, cmd['addr'], cmd['size'])
+        if not send(ser, msg):
+            failed += 1
+    return time.monotonic() - start, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the VS2 receive path against a simulated 4800 baud link')
+    parser.add_argument('--cycles', type=int, default=1, help='number of full readCmds cycles per receive path')
+    args = parser.parse_args()
+
+    ser = SimulatedSerial()
+    if not vs2.startCommunication(ser):
+        print('Handshake failed')
+        return
+    for name, send in [('100ms polling', legacySendVS2Message), ('deadline read', vs2.sendVS2Message)]:
+        for cycle in range(args.cycles):
+            duration, failed = runCycle(ser, send)
+            print('%-14s cycle %d: %d requests in %.2fs (%.1fms per request, %d failed)' % (name, cycle, len(v2m.readCmds), duration, duration * 1000 / len(v2m.readCmds), failed))
+
+if __name__ == '__main__':
+    main()
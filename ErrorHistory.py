@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Incremental tracking of an error history of the unit: a ring of entries, the newest one first,
+# which only changes when a new fault happens.
+
+import time
+
+class ErrorHistory():
+    """An error history of slots entries of size bytes at addr.
+
+    Only the newest entry is polled: watch() tells if it changed, then the whole ring is read
+    once and update() returns its entries and the faults which were not in it before. Every
+    entry is decoded only once, decodeEntry(bytes) returns None for empty slots. As the newest
+    entry might not always be the first one, the ring is also read every refresh seconds and
+    after invalidate(). The new faults are found by content, not by slot.
+    """
+    def __init__(self, addr, slots, size, decodeEntry, refresh=None):
+        self.addr = addr
+        self.slots = slots
+        self.size = size
+        self.decodeEntry = decodeEntry
+        self.refresh = refresh
+        self.newest = None # bytes of the newest entry at the last update
+        self.updated = 0 # time.monotonic() of the last update
+        self.entries = None # bytes: decoded entry of the ring, None till the first update
+
+    def watch(self, data, now=None):
+        # True if the ring has to be read, the newest entry is not the one of the last update or
+        # the last update is older than refresh seconds
+        if bytes(data) != self.newest:
+            return True
+        if now is None:
+            now = time.monotonic()
+        return self.refresh is not None and now - self.updated >= self.refresh
+
+    def invalidate(self):
+        # the ring is read with the next watch()
+        self.newest = None
+
+    def update(self, data):
+        # the decoded entries of the ring read from addr and the new ones
+        entries = {}
+        new = []
+        for offset in range(0, self.slots * self.size, self.size):
+            raw = bytes(data[offset:offset + self.size])
+            if raw in entries:
+                continue
+            if self.entries is not None and raw in self.entries:
+                entries[raw] = self.entries[raw]
+                continue
+            entries[raw] = self.decodeEntry(raw)
+            if self.entries is not None and entries[raw] is not None:
+                new.append(entries[raw])
+        self.entries = entries
+        self.newest = bytes(data[:self.size])
+        self.updated = time.monotonic()
+        return [entry for entry in entries.values() if entry is not None], new
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+# Publishing of single values to their own MQTT topics, only if they changed.
+
+# seconds after which a value is published again, even if it did not change
+PUBLISH_REFRESH = 600
+
+class ChangePublisher():
+    """Publishes every value to topic + key, but only if it differs from the last published one.
+
+    Numeric values have to change by more than the given deadband. Every refresh seconds a
+    value is published again, so late subscribers and broker restarts are covered. force
+    publishes the value in any case, e.g. to confirm a write.
+    """
+    def __init__(self, mqc, topic, refresh=PUBLISH_REFRESH, qos=0, retain=True):
+        self.mqc = mqc
+        self.topic = topic
+        self.refresh = refresh
+        self.qos = qos
+        self.retain = retain
+        self.published = {} # key: (time of publishing, payload)
+
+    def changed(self, key, payload, deadband=0, now=None):
+        last = self.published.get(key)
+        if last is None or now - last[0] >= self.refresh:
+            return True
+        if payload == last[1]:
+            return False
+        if deadband:
+            try:
+                return abs(float(payload) - float(last[1])) > deadband
+            except ValueError:
+                pass # not a numeric value
+        return True
+
+    def publish(self, key, payload, deadband=0, now=None, force=False):
+        if now is None:
+            now = time.monotonic()
+        if not force and not self.changed(key, payload, deadband, now):
+            return False
+        self.mqc.publish(self.topic + key, payload, qos=self.qos, retain=self.retain)
+        self.published[key] = (now, payload)
+        return True
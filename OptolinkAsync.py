@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import binascii
+import io
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from OptolinkMetrics import registry
+from OptolinkTrace import NULL_SPAN, tracer
+from VS2Protocol import READ, WRITE, RESPONSE_TIMEOUT, INTER_BYTE_TIMEOUT, FunctionCodes, MessageIdentifier, ProtocolIdentifier, ResponseTimer, VS2FrameDecoder, VS2Message, handshakeSteps, exchangeSteps, requestMessage
+
+# asyncio engine for the Optolink: an async serial transport, VS2 and VS1 sessions and the
+# integration of the paho MQTT client into the event loop. Reads, writes, keepalives and
+# publishing run as tasks of one event loop, the sessions serialize the exchanges on the link,
+# so several consumers can share it.
+
+VS1_READ = 0xF7
+VS1_WRITE = 0xF4
+VS1_TIMEOUT = 1.0 # kw1.py waits 1s for the reply of a VS1 request
+VS1_SYNC_TIMEOUT = 3.0 # the unit sends an ENQ every 2s while no session is open
+VS1_KEEPALIVE_INTERVAL = 0.5 # like Vitosoft, see VitosoftCommunication.md
+
+# A unit which supports VS2 answers the 0x01 opening a VS1 session with VS2_ACK or VS2_NACK right away,
+# see openSession().
+VS2_DETECT_TIMEOUT = 0.2
+VS2_TRIES = 5 # tries of AsyncVS2Session.read() and write()
+
+# The unit drops a VS2 session after about 5s without a request, so idle sessions read the
+# device identification every KEEPALIVE_INTERVAL seconds.
+KEEPALIVE_INTERVAL = 2.0
+KEEPALIVE_ADDR = 0x00F8
+
+class AsyncSerial():
+    """Async reads and writes on a pyserial port (serial_for_url).
+
+    Ports with a file descriptor (serial ports and socket:// URLs on POSIX) are read without
+    blocking, when the event loop reports them readable. Other ports, like the SimulatedSerial,
+    are read with blocking reads in the default executor.
+    """
+    def __init__(self, ser):
+        self.ser = ser
+        try:
+            self.fd = ser.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.fd = None
+        if self.fd is not None:
+            ser.timeout = 0 # read() returns what is available
+        self.lastReceived = 0 # time.monotonic() of the last received bytes
+
+    async def _readable(self, timeout):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        loop.add_reader(self.fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(self.fd)
+
+    async def read(self, size, deadline, interByteTimeout=None):
+        # reads up to size bytes till the deadline (time.monotonic()) or a gap of interByteTimeout
+        if self.fd is None:
+            def blockingRead():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return bytes()
+                self.ser.timeout = remaining
+                self.ser.inter_byte_timeout = interByteTimeout
+                return self.ser.read(size)
+            data = await asyncio.get_running_loop().run_in_executor(None, blockingRead)
+            if data:
+                self.lastReceived = time.monotonic()
+            return data
+        buf = bytearray()
+        while len(buf) < size:
+            data = self.ser.read(size - len(buf))
+            if data:
+                buf += data
+                lastByte = self.lastReceived = time.monotonic()
+                continue
+            end = deadline
+            if buf and interByteTimeout is not None:
+                end = min(end, lastByte + interByteTimeout) # the unit stopped sending
+            timeout = end - time.monotonic()
+            if timeout <= 0:
+                break
+            await self._readable(timeout)
+        return bytes(buf)
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def resetInput(self):
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        self.ser.close()
+
+async def runStepsAsync(port, steps):
+    # runs an exchange of VS2Protocol.py on an AsyncSerial and returns its result
+    try:
+        step = next(steps)
+        while True:
+            if step[0] == READ:
+                step = steps.send(await port.read(step[1], step[2], step[3]))
+            elif step[0] == WRITE:
+                port.write(step[1])
+                step = steps.send(None)
+            else:
+                port.resetInput()
+                step = steps.send(None)
+    except StopIteration as e:
+        return e.value
+
+class AsyncVS2Session():
+    """A VS2 session on an AsyncSerial, one exchange at a time.
+
+    send() starts the communication first, if it is not started yet. The reply is a VS2Message
+    whose data points into the decoder buffer, it is only valid till the next exchange. The
+    reply timeout adapts to the response time of the unit, see ResponseTimer.
+
+    keepalive() keeps an idle session open. If the unit does not answer a request at all or
+    sends an ENQ, the session is considered lost and started again right away, so the retry of
+    the caller doesn't run into the next timeout.
+
+    read() and write() are the virtual read and write requests with the results of the ones of
+    AsyncVS1Session, so both sessions can be used alike.
+    """
+    def __init__(self, port, timeout=RESPONSE_TIMEOUT, interByteTimeout=INTER_BYTE_TIMEOUT, metrics=registry):
+        self.port = port
+        self.timeout = timeout
+        self.interByteTimeout = interByteTimeout
+        self.metrics = metrics
+        self.decoder = VS2FrameDecoder()
+        self.timer = ResponseTimer(timeout)
+        self.lock = asyncio.Lock()
+        self.started = False
+        self.lastExchange = 0
+
+    async def start(self):
+        async with self.lock:
+            return await self._start()
+
+    async def _start(self):
+        self.started = await runStepsAsync(self.port, handshakeSteps(self.timeout, self.decoder, self.metrics))
+        self.lastExchange = time.monotonic()
+        if self.started:
+            logging.info('### connectionn estabilished')
+        return self.started
+
+    async def send(self, message, attempt=0):
+        # attempt is the number of the retry, which gets a longer timeout
+        async with self.lock:
+            if not self.started and not await self._start():
+                return None
+            start = time.monotonic()
+            enqCount = self.decoder.enqCount
+            reply = await runStepsAsync(self.port, exchangeSteps(message, self.timer.timeout(message, attempt), self.interByteTimeout, self.decoder, self.metrics))
+            self.lastExchange = time.monotonic()
+            if reply is not None:
+                self.timer.observe(message, self.lastExchange - start)
+            elif self.port.lastReceived < start or self.decoder.enqCount > enqCount: # the unit dropped the session
+                logging.warning('VS2 session lost, starting it again')
+                self.metrics.inc('optolink_session_losses_total')
+                with tracer.span('handshake') if tracer.enabled else NULL_SPAN as span:
+                    span.set('result', await self._start())
+            return reply
+
+    async def read(self, addr, size, tries=VS2_TRIES):
+        # the bytes read, empty if the unit did not answer or answered with an ErrorMessage
+        message = requestMessage(FunctionCodes.Virtual_READ, addr, size)
+        for attempt in range(tries):
+            reply = await self.send(message, attempt)
+            if reply is not None:
+                return bytes(reply.Data) if reply.identifier == MessageIdentifier.ResponseMessage else bytes()
+        return bytes()
+
+    async def write(self, addr, data, tries=VS2_TRIES):
+        message = VS2Message(ProtocolIdentifier.LDAP, MessageIdentifier.RequestMessage, FunctionCodes.Virtual_WRITE, addr, len(data), bytes(data))
+        for attempt in range(tries):
+            reply = await self.send(message, attempt)
+            if reply is not None:
+                return reply.identifier == MessageIdentifier.ResponseMessage
+        return False
+
+    async def keepalive(self, interval=KEEPALIVE_INTERVAL):
+        # runs till it is cancelled, reads KEEPALIVE_ADDR whenever the session was idle for interval seconds
+        message = requestMessage(FunctionCodes.Virtual_READ, KEEPALIVE_ADDR, 2)
+        while True:
+            idle = time.monotonic() - self.lastExchange
+            if idle < interval:
+                await asyncio.sleep(interval - idle)
+            elif self.started:
+                with tracer.span('keepalive') if tracer.enabled else NULL_SPAN:
+                    await self.send(message)
+            else:
+                await asyncio.sleep(interval) # the poll loop starts the session
+
+class AsyncVS1Session():
+    """A VS1 (KW) session on an AsyncSerial: read() and write() are the virtual read and write
+    requests.
+
+    The session stays open: keepalive() reads KEEPALIVE_ADDR whenever it was idle for 500ms. Only
+    after an error, a short reply or a failed write, read() and write() sync() again: an EOT ends
+    what is left of the session, then the ENQ of the unit is answered with 0x01.
+    """
+    def __init__(self, port, timeout=VS1_TIMEOUT):
+        self.port = port
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+        self.opened = False
+        self.lastExchange = 0
+
+    async def sync(self, timeout=VS1_SYNC_TIMEOUT):
+        async with self.lock:
+            return await self._sync(timeout)
+
+    async def _sync(self, timeout=VS1_SYNC_TIMEOUT):
+        self.port.resetInput()
+        self.port.write(binascii.unhexlify('04'))
+        self.opened = await self.port.read(1, time.monotonic() + timeout) == binascii.unhexlify('05')
+        if self.opened:
+            self.port.write(binascii.unhexlify('01'))
+        self.lastExchange = time.monotonic()
+        return self.opened
+
+    async def read(self, addr, size):
+        # the bytes read, short if the unit did not answer in time
+        async with self.lock:
+            if not self.opened and not await self._sync():
+                return bytes()
+            self.port.write(bytes([VS1_READ, addr >> 8, addr & 0xFF, size]))
+            data = await self.port.read(size, time.monotonic() + self.timeout)
+            self.lastExchange = time.monotonic()
+            if len(data) < size:
+                logging.warning('VS1 read of 0x%04x failed, syncing again' % addr)
+                self.opened = False
+            return data
+
+    async def write(self, addr, data):
+        async with self.lock:
+            if not self.opened and not await self._sync():
+                return False
+            self.port.write(bytes([VS1_WRITE, addr >> 8, addr & 0xFF, len(data)]) + bytes(data))
+            self.opened = await self.port.read(1, time.monotonic() + self.timeout) == binascii.unhexlify('00')
+            self.lastExchange = time.monotonic()
+            return self.opened
+
+    async def keepalive(self, interval=VS1_KEEPALIVE_INTERVAL):
+        # runs till it is cancelled, reads KEEPALIVE_ADDR whenever the open session was idle for interval seconds
+        while True:
+            idle = time.monotonic() - self.lastExchange
+            if idle < interval:
+                await asyncio.sleep(interval - idle)
+            elif self.opened:
+                await self.read(KEEPALIVE_ADDR, 2)
+            else:
+                await asyncio.sleep(interval) # the next read syncs
+
+async def openSession(port, metrics=registry):
+    """Opens a VS1 session and returns it, or a VS2 session if the unit supports VS2.
+
+    Returns None if the unit did not send an ENQ.
+    """
+    vs1 = AsyncVS1Session(port)
+    if not await vs1.sync():
+        return None
+    if await port.read(1, time.monotonic() + VS2_DETECT_TIMEOUT) in (binascii.unhexlify('06'), binascii.unhexlify('15')):
+        logging.info('The unit supports VS2, using it instead of VS1')
+        return AsyncVS2Session(port, metrics=metrics)
+    return vs1
+
+class AsyncMQTTClient():
+    """Runs the network loop of a paho MQTT client in the event loop instead of loop_start().
+
+    publish() of the client only queues the message, the socket is written as soon as it is
+    writable, so publishing never blocks the link. Lost connections are reconnected.
+
+    connect() and reconnect() of paho block till the TCP connection is up, so they run in the
+    executor. The socket callbacks they fire are handed over to the event loop thread, as the
+    event loop is not thread-safe.
+    """
+    def __init__(self, mqc, reconnectDelay=5):
+        self.mqc = mqc
+        self.reconnectDelay = reconnectDelay
+        self.loop = None
+        self.thread = None
+        self.task = None
+        mqc.on_socket_open = self._socketOpen
+        mqc.on_socket_close = self._socketClose
+        mqc.on_socket_register_write = self._registerWrite
+        mqc.on_socket_unregister_write = self._unregisterWrite
+
+    def _inLoop(self, callback, *args):
+        # calls callback in the event loop thread, right away if this is the one
+        if threading.get_ident() == self.thread:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def _socketOpen(self, client, userdata, sock):
+        self._inLoop(self.loop.add_reader, sock, client.loop_read)
+
+    def _socketClose(self, client, userdata, sock):
+        # by file descriptor, paho closes the socket right after this callback
+        self._inLoop(self._removeSocket, sock.fileno())
+
+    def _removeSocket(self, fd):
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    def _registerWrite(self, client, userdata, sock):
+        self._inLoop(self.loop.add_writer, sock, client.loop_write)
+
+    def _unregisterWrite(self, client, userdata, sock):
+        self._inLoop(self.loop.remove_writer, sock.fileno())
+
+    async def connect(self, host, port=1883, keepalive=60):
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.get_ident()
+        await self.loop.run_in_executor(None, self.mqc.connect, host, port, keepalive)
+        self.task = asyncio.ensure_future(self._misc())
+
+    async def _misc(self):
+        # keepalive pings and reconnects, like the thread of loop_start()
+        while True:
+            await asyncio.sleep(1)
+            if self.mqc.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(self.reconnectDelay)
+                try:
+                    await self.loop.run_in_executor(None, self.mqc.reconnect)
+                except OSError as e:
+                    logging.warning('MQTT reconnect failed [%s]' % e)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import http.server
+import json
+import threading
+
+# Counters, gauges and histograms of the Optolink link and the poller, exposed in the Prometheus
+# text format over HTTP (serveMetrics) and as a JSON document, e.g. for publishing to MQTT.
+
+# upper bounds in seconds, a VS2 request of a few bytes takes about 50ms at 4800 baud
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+CYCLE_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120)
+
+HELP = {
+    'optolink_request_seconds': 'Round trip time of successful requests, from sending the request to the complete reply',
+    'optolink_timeouts_total': 'Requests without a complete reply in time',
+    'optolink_nacks_total': 'Requests answered with VS2_NACK',
+    'optolink_checksum_errors_total': 'Replies with a wrong checksum',
+    'optolink_error_messages_total': 'Requests answered with an ErrorMessage',
+    'optolink_retries_total': 'Requests which were sent again',
+    'optolink_failed_reads_total': 'Reads which failed after all tries',
+    'optolink_handshakes_total': 'Handshakes to (re)start the communication',
+    'optolink_session_losses_total': 'Sessions which the unit dropped',
+    'optolink_cycle_seconds': 'Time to read all due datapoints',
+    'optolink_queue_depth': 'Read requests which are due',
+    'optolink_circuit_opened_total': 'Read blocks which were suspended after repeated failures',
+    'optolink_open_circuits': 'Read blocks which are suspended and only probed from time to time',
+    'optolink_link_restarts_total': 'Restarts of a link after an error',
+    'optolink_writes_total': 'Writes of datapoints received over MQTT',
+    'optolink_write_seconds': 'Time from receiving a write over MQTT to publishing the value read back',
+}
+
+class Histogram():
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsStore():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {} # (name, labels): value or Histogram
+        self.types = {} # name: counter, gauge or histogram
+
+class Metrics():
+    """Registry of the metrics, safe to use from several threads.
+
+    Labels are passed as keyword arguments. labelled() returns a view on the same store, which
+    adds its labels to every metric, e.g. to tell several links apart.
+    """
+    def __init__(self, store=None, labels=()):
+        self.store = store or MetricsStore()
+        self.labels = labels
+
+    def labelled(self, **labels):
+        return Metrics(self.store, self.labels + tuple(sorted(labels.items())))
+
+    def _key(self, name, labels):
+        return (name, self.labels + tuple(sorted(labels.items())) if labels else self.labels)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.store.lock:
+            self.store.types[name] = 'counter'
+            self.store.values[key] = self.store.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.store.lock:
+            self.store.types[name] = 'gauge'
+            self.store.values[key] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self.store.lock:
+            histogram = self.store.values.get(key)
+            if histogram is None:
+                self.store.types[name] = 'histogram'
+                histogram = self.store.values[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+        # Prometheus text format
+        lines = []
+        with self.store.lock:
+            for name in sorted(self.store.types):
+                if name in HELP:
+                    lines.append('# HELP %s %s' % (name, HELP[name]))
+                lines.append('# TYPE %s %s' % (name, self.store.types[name]))
+                for (key, labels), value in sorted(self.store.values.items(), key=lambda item: item[0]):
+                    if key != name:
+                        continue
+                    if isinstance(value, Histogram):
+                        cumulative = 0
+                        for bound, count in zip(value.buckets + ('+Inf',), value.counts):
+                            cumulative += count
+                            lines.append('%s_bucket%s %d' % (name, formatLabels(labels + (('le', bound),)), cumulative))
+                        lines.append('%s_sum%s %g' % (name, formatLabels(labels), value.sum))
+                        lines.append('%s_count%s %d' % (name, formatLabels(labels), value.count))
+                    else:
+                        lines.append('%s%s %g' % (name, formatLabels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        # all metrics as a dict, histograms with count, sum and the (not cumulative) bucket counts
+        result = {}
+        with self.store.lock:
+            for (name, labels), value in sorted(self.store.values.items(), key=lambda item: item[0]):
+                if isinstance(value, Histogram):
+                    value = {'count': value.count, 'sum': value.sum,
+                             'buckets': {str(bound): count for bound, count in zip(value.buckets + ('+Inf',), value.counts)}}
+                result[name + formatLabels(labels)] = value
+        return result
+
+    def json(self):
+        return json.dumps(self.snapshot())
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, value) for key, value in labels)
+
+# the metrics of this process, the protocol functions count into it by default
+registry = Metrics()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    metrics = registry
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, contentType = self.metrics.render().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, contentType = self.metrics.json().encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # no log line per scrape
+
+def serveMetrics(port, metrics=registry, host=''):
+    # serves /metrics (Prometheus) and /metrics.json in a background thread
+    handler = type('Handler', (MetricsHandler,), {'metrics': metrics})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
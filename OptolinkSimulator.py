@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import os
+import random
+import select
+import socket
+import sys
+import threading
+import time
+import tty
+from VS2Protocol import FunctionCodes, MessageIdentifier, VS2Message, VS2_DAP_STANDARD
+
+# Simulates a Vitotronic controller behind an Optolink, speaking VS1 and/or VS2 as described in
+# VitosoftCommunication.md. It can be used as a serial port object (SimulatedSerial) or be
+# served on TCP (or a pty), so the scripts can be run and benchmarked without a heating unit:
+#
+#   python3 OptolinkSimulator.py --nack 0.01
+#
+# and then set SERIAL_PORT in Viessmann2MQTT.py or kw1.py to the printed socket:// URL.
+
+BAUDRATE = 4800
+TURNAROUND = 0.005 # time the unit needs to start answering a request
+ENQ_INTERVAL = 2.0 # without a session the unit sends an ENQ every 2s
+SESSION_TIMEOUT = 5.0 # the unit drops the session after 5s of silence
+
+VS1_READ = 0xF7
+VS1_WRITE = 0xF4
+
+def byteTime(baudrate=BAUDRATE):
+    # 8E2: 1 start, 8 data, 1 parity and 2 stop bits
+    return 12 / baudrate
+
+def bcd(value):
+    return ((value // 10) << 4) | (value % 10)
+
+def defaultMemory():
+    # a plausible memory map for the datapoints of Viessmann2MQTT.py and kw1.py
+    memory = {}
+    memory[0x00F8] = bytes([0x20, 0x94, 0, 0, 0, 0, 0, 0]) # ID
+    date = bytes([bcd(20), bcd(26), bcd(10), bcd(18), 6, bcd(12), bcd(0), bcd(0)]) # 2026-10-18 12:00:00, Sunday
+    memory[0x088E] = date
+    for slot in range(10):
+        memory[0x7507 + 9 * slot] = bytes([0]) + date # Fehlerhistorie
+    for slot in range(20):
+        memory[0x7590 + 9 * slot] = bytes([0]) + date # Fehlerhistorie FA
+    memory[0x7561] = bytes(10) # ErrorIndex
+    phases = bytes([6 << 3, 22 << 3]) + bytes([0xFF] * 6) # 06:00-22:00 on every day
+    for addr in [0x2000, 0x2100, 0x2200, 0x3000, 0x3100, 0x3200, 0x4000, 0x4100, 0x4200]:
+        memory[addr] = phases * 7
+    for addr, value in [(0x0800, 123), (0x0802, 550), (0x0804, 485), (0x0810, 550), (0x0812, 480), (0x0814, 470), (0x0816, 900),
+                        (0x081A, 450), (0x3900, 350), (0x4900, 340), (0x5502, 560), (0x5525, 120), (0x5527, 118), (0x555A, 560),
+                        (0x6500, 500), (0x6564, 250), (0x6566, 420)]:
+        memory[addr] = value.to_bytes(2, 'little', signed=True)
+    memory[0x088A] = (12345).to_bytes(4, 'little')
+    memory[0x08A7] = (3600 * 4711).to_bytes(4, 'little')
+    memory[0x08AB] = (3600 * 42).to_bytes(4, 'little')
+    memory[0x2301] = bytes([2]) # Betriebsart normal
+    memory[0x2306] = bytes([20]) # Raumsoll
+    memory[0x2308] = bytes([22]) # Partytemperatur
+    memory[0x6300] = bytes([50]) # Warmwasser Soll
+    return memory
+
+class VitotronicSimulator():
+    """Protocol state machine of the simulated controller.
+
+    receive() processes the bytes sent by the host and returns the reply bytes, poll() the bytes
+    the unit sends on its own (ENQ without a session). The timing is done by the transport.
+    Faults are injected randomly: nackRate answers a VS2 request with a NACK, checksumErrorRate
+    corrupts the reply (the checksum for VS2, a data byte for VS1) and dropRate drops single
+    reply bytes.
+    """
+    def __init__(self, memory=None, protocols=('VS1', 'VS2'), strict=False, nackRate=0, checksumErrorRate=0, dropRate=0, turnaround=TURNAROUND, seed=None):
+        self.memory = bytearray(0x10000)
+        self.known = bytearray([0 if strict else 1]) * 0x10000 # readable addresses
+        self.protocols = protocols
+        self.nackRate = nackRate
+        self.checksumErrorRate = checksumErrorRate
+        self.dropRate = dropRate
+        self.turnaround = turnaround
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.state = 'idle'
+        self.input = bytearray()
+        self.lastActivity = 0
+        self.lastEnq = 0
+        self.stats = collections.Counter()
+        self.load(defaultMemory() if memory is None else memory)
+
+    def load(self, memory):
+        for addr, data in memory.items():
+            self.memory[addr:addr + len(data)] = data
+            self.known[addr:addr + len(data)] = bytes([1]) * len(data)
+
+    def readable(self, addr, size):
+        return addr + size <= len(self.memory) and all(self.known[addr:addr + size])
+
+    def poll(self, now):
+        with self.lock:
+            if self.state != 'idle' and now - self.lastActivity > SESSION_TIMEOUT:
+                self.state = 'idle'
+                self.stats['sessionTimeouts'] += 1
+            if self.state == 'idle' and now - self.lastEnq >= ENQ_INTERVAL:
+                self.lastEnq = now
+                self.stats['txBytes'] += 1
+                return b'\x05'
+            return bytes()
+
+    def receive(self, data, now):
+        with self.lock:
+            if self.state != 'idle' and now - self.lastActivity > SESSION_TIMEOUT:
+                self.state = 'idle'
+                self.stats['sessionTimeouts'] += 1
+            self.lastActivity = now
+            self.stats['rxBytes'] += len(data)
+            self.input += data
+            out = bytearray()
+            while self.input:
+                consumed = self._process(out, now)
+                if not consumed:
+                    break
+                del self.input[:consumed]
+            out = self._faults(out)
+            self.stats['txBytes'] += len(out)
+            return bytes(out)
+
+    def _process(self, out, now):
+        # handles the next command in the input, returns the number of consumed bytes, 0 if incomplete
+        b = self.input[0]
+        if b == 0x04: # EOT
+            self.state = 'idle'
+            self.lastEnq = now
+            out.append(0x05)
+            return 1
+        if b == 0x16: # VS2_START_VS2, 0, 0
+            if len(self.input) < 3:
+                return 0
+            if 'VS2' in self.protocols and self.input[1:3] == b'\x00\x00':
+                self.state = 'vs2'
+                out.append(0x06)
+            return 3
+        if self.state == 'idle':
+            if b == 0x01 and 'VS1' in self.protocols:
+                self.state = 'vs1'
+                if 'VS2' in self.protocols:
+                    out.append(0x06) # tells the host, that VS2 is supported as well
+            return 1
+        if self.state == 'vs1':
+            return self._processVS1(out)
+        return self._processVS2(out)
+
+    def _processVS1(self, out):
+        fc = self.input[0]
+        if fc not in (VS1_READ, VS1_WRITE):
+            return 1 # unknown, skip it
+        if len(self.input) < 4:
+            return 0
+        addr = (self.input[1] << 8) + self.input[2]
+        size = self.input[3]
+        self.stats['requests'] += 1
+        if fc == VS1_READ:
+            out += self.memory[addr:addr + size]
+            return 4
+        if len(self.input) < 4 + size:
+            return 0
+        self.memory[addr:addr + size] = self.input[4:4 + size]
+        out.append(0x00)
+        return 4 + size
+
+    def _processVS2(self, out):
+        b = self.input[0]
+        if b != VS2_DAP_STANDARD:
+            return 1 # the host ACKs our replies, nothing to do
+        if len(self.input) < 2 or len(self.input) < self.input[1] + 3:
+            return 0
+        size = self.input[1]
+        frame = self.input[:size + 3]
+        self.stats['requests'] += 1
+        if sum(frame[1:-1]) & 0xFF != frame[-1] or self.random.random() < self.nackRate:
+            self.stats['nacks'] += 1
+            out.append(0x15)
+            return size + 3
+        out.append(0x06)
+        request = VS2Message(bytes(frame[2:-1]))
+        identifier = MessageIdentifier.ResponseMessage
+        data = None
+        if request.Command == FunctionCodes.Virtual_READ and self.readable(request.ADDR, request.BlockSize):
+            data = bytes(self.memory[request.ADDR:request.ADDR + request.BlockSize])
+        elif request.Command == FunctionCodes.Virtual_WRITE and len(request.Data) == request.BlockSize:
+            self.memory[request.ADDR:request.ADDR + request.BlockSize] = request.Data
+        else:
+            identifier = MessageIdentifier.ErrorMessage
+            self.stats['errorMessages'] += 1
+        if request.identifier != MessageIdentifier.UNACKDMessage:
+            out += VS2Message(request.protocol, identifier, request.Command, request.ADDR, request.BlockSize, data).msgBytes
+        return size + 3
+
+    def _faults(self, out):
+        if len(out) > 1 and self.random.random() < self.checksumErrorRate:
+            out[-1] ^= 0xFF
+            self.stats['corrupted'] += 1
+        if self.dropRate:
+            kept = bytearray(b for b in out if self.random.random() >= self.dropRate)
+            self.stats['dropped'] += len(out) - len(kept)
+            out = kept
+        return out
+
+class SimulatedSerial():
+    """A serial.Serial replacement, connected to a VitotronicSimulator with the byte timing of the link.
+
+    Supports write, read with timeout and inter_byte_timeout, in_waiting, reset_input_buffer,
+    flush and close.
+    """
+    def __init__(self, simulator=None, baudrate=BAUDRATE):
+        self.simulator = VitotronicSimulator() if simulator is None else simulator
+        self.byteTime = byteTime(baudrate)
+        self.timeout = None
+        self.inter_byte_timeout = None
+        self.is_open = True
+        self.rx = collections.deque() # (time the byte is received, byte)
+        self.lineFree = 0 # time the host has sent its last byte
+
+    def _schedule(self, data, start):
+        if self.rx:
+            start = max(start, self.rx[-1][0])
+        for b in data:
+            start += self.byteTime
+            self.rx.append((start, b))
+
+    def write(self, data):
+        arrival = max(time.monotonic(), self.lineFree) + len(data) * self.byteTime
+        self.lineFree = arrival
+        self._schedule(self.simulator.receive(bytes(data), arrival), arrival + self.simulator.turnaround)
+        return len(data)
+
+    def _idle(self, now):
+        if not self.rx:
+            self._schedule(self.simulator.poll(now), now)
+
+    @property
+    def in_waiting(self):
+        now = time.monotonic()
+        self._idle(now)
+        return sum(1 for t, _ in self.rx if t <= now)
+
+    def read(self, size=1):
+        start = time.monotonic()
+        lastByte = start
+        buf = bytearray()
+        while len(buf) < size:
+            now = time.monotonic()
+            self._idle(now)
+            if self.rx and self.rx[0][0] <= now:
+                buf.append(self.rx.popleft()[1])
+                lastByte = now
+                continue
+            wake = [self.rx[0][0] if self.rx else now + ENQ_INTERVAL]
+            if self.timeout is not None:
+                if now - start >= self.timeout:
+                    break
+                wake.append(start + self.timeout)
+            if buf and self.inter_byte_timeout is not None:
+                if now - lastByte >= self.inter_byte_timeout:
+                    break
+                wake.append(lastByte + self.inter_byte_timeout)
+            time.sleep(max(0, min(wake) - now))
+        return bytes(buf)
+
+    def reset_input_buffer(self):
+        now = time.monotonic()
+        while self.rx and self.rx[0][0] <= now:
+            self.rx.popleft()
+
+    def flush(self):
+        time.sleep(max(0, self.lineFree - time.monotonic()))
+
+    def close(self):
+        self.is_open = False
+
+def serve(simulator, fd, recv, send, baudrate=BAUDRATE):
+    # runs the simulator on a file descriptor with the byte timing of the link, till it is closed
+    step = byteTime(baudrate)
+    pending = collections.deque() # (time to send, byte)
+    while True:
+        now = time.monotonic()
+        if not pending:
+            for b in simulator.poll(now):
+                pending.append((now, b))
+        timeout = max(0, pending[0][0] - now) if pending else ENQ_INTERVAL / 4
+        readable, _, _ = select.select([fd], [], [], timeout)
+        now = time.monotonic()
+        if readable:
+            data = recv(1024)
+            if not data:
+                return
+            # the request is received once its last byte is transferred
+            arrival = now + len(data) * step
+            t = max(arrival + simulator.turnaround, pending[-1][0] if pending else 0)
+            for b in simulator.receive(data, arrival):
+                t += step
+                pending.append((t, b))
+        while pending and pending[0][0] <= now:
+            send(bytes([pending.popleft()[1]]))
+
+def runPty(simulator):
+    # Linux ptys do not accept the even parity, so only clients which don't set it can use this
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print('Simulated Optolink on %s' % os.ttyname(slave), flush=True)
+    serve(simulator, master, lambda size: os.read(master, size), lambda data: os.write(master, data))
+
+def runTcp(simulator, port):
+    # serves one client at a time, which can connect with pyserial as socket://localhost:<port>
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('localhost', port))
+    sock.listen(1)
+    print('Simulated Optolink on socket://localhost:%d' % port, flush=True)
+    while True:
+        connection, _ = sock.accept()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with connection:
+            serve(simulator, connection, connection.recv, connection.sendall)
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates a Vitotronic controller with Optolink on a TCP port (socket://localhost:PORT) or with --pty on a pty')
+    parser.add_argument('--protocol', choices=['VS1', 'VS2', 'both'], default='both', help='supported protocols')
+    parser.add_argument('--strict', action='store_true', help='only addresses of the memory map are readable')
+    parser.add_argument('--nack', type=float, default=0, help='probability of a NACK for a VS2 request')
+    parser.add_argument('--checksum', type=float, default=0, help='probability of a corrupted reply')
+    parser.add_argument('--drop', type=float, default=0, help='probability to drop a reply byte')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the fault injection')
+    parser.add_argument('--port', type=int, default=45317, help='TCP port to serve the simulator on')
+    parser.add_argument('--pty', action='store_true', help='serve the simulator on a pty instead of TCP')
+    args = parser.parse_args()
+
+    protocols = ('VS1', 'VS2') if args.protocol == 'both' else (args.protocol,)
+    simulator = VitotronicSimulator(protocols=protocols, strict=args.strict, nackRate=args.nack, checksumErrorRate=args.checksum, dropRate=args.drop, seed=args.seed)
+    try:
+        if args.pty:
+            runPty(simulator)
+        else:
+            runTcp(simulator, args.port)
+    except KeyboardInterrupt:
+        print(dict(simulator.stats), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
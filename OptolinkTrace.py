@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import contextvars
+import json
+import os
+import threading
+import time
+
+# Optional tracing of the poll cycles: one span per phase (handshake, read, decode, publish) and per
+# request, with the times of sending, the first reply byte and the complete frame, and instant
+# events for NACKs and resyncs of the frame decoder. The spans are written in the Chrome trace event
+# format to a rotating file, which can be opened with https://ui.perfetto.dev or chrome://tracing.
+# While tracing is disabled, span() returns a shared no-op span and the protocol functions skip all
+# timing with a check of tracer.enabled. Callers check tracer.enabled before building span names and
+# arguments and use NULL_SPAN otherwise.
+
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUPS = 3
+
+class NullSpan():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, key, value):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Span():
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.start, time.monotonic(), **self.args)
+        return False
+
+    def set(self, key, value):
+        self.args[key] = value
+
+class Tracer():
+    """Writes trace events to a file, which is rotated after maxBytes like a RotatingFileHandler.
+
+    The file is a JSON array without the closing bracket, which the trace viewers accept, so it
+    stays loadable at any time, even if the process is killed. Timestamps are time.monotonic()
+    values, like the ones of the protocol functions.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.file = None
+        self.filename = None
+        self.pid = os.getpid()
+        self.lane = contextvars.ContextVar('lane', default=None)
+        self.lanes = {} # name: tid
+
+    def open(self, filename, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUPS):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.file = open(filename, 'w')
+        self.file.write('[\n')
+        self.enabled = True
+
+    def close(self):
+        self.enabled = False
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backupCount - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.filename, i)):
+                os.replace('%s.%d' % (self.filename, i), '%s.%d' % (self.filename, i + 1))
+        if self.backupCount:
+            os.replace(self.filename, self.filename + '.1')
+        self.file = open(self.filename, 'w')
+        self.file.write('[\n')
+        for name, tid in self.lanes.items():
+            self.file.write(self.laneName(name, tid))
+
+    def laneName(self, name, tid):
+        return json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}) + ',\n'
+
+    def setLane(self, name):
+        # the events of the current asyncio task (and the tasks it starts) are shown in their own row
+        with self.lock:
+            if name not in self.lanes:
+                self.lanes[name] = tid = len(self.lanes) + 1
+                if self.file:
+                    self.file.write(self.laneName(name, tid))
+        self.lane.set(self.lanes[name])
+
+    def write(self, event):
+        event['pid'] = self.pid
+        event['tid'] = self.lane.get() or threading.get_ident()
+        line = json.dumps(event) + ',\n'
+        with self.lock:
+            if not self.file:
+                return
+            if self.file.tell() + len(line) > self.maxBytes:
+                self.rotate()
+            self.file.write(line)
+
+    def flush(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def complete(self, name, start, end, **args):
+        # a span from start to end
+        if self.enabled:
+            self.write({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6, 'args': args})
+
+    def instant(self, name, ts=None, **args):
+        if self.enabled:
+            self.write({'name': name, 'ph': 'i', 's': 't', 'ts': (time.monotonic() if ts is None else ts) * 1e6, 'args': args})
+
+# the tracer of this process, disabled till it is opened
+tracer = Tracer()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import time
+from VS2Protocol import FunctionCodes
+
+# Polling of a list of datapoints (like readCmds in Viessmann2MQTT.py) over a VS2 link.
+
+# The block length byte allows 255 bytes, but the message length byte also covers the 5 header
+# bytes. Units might not accept that much, so the default is lower.
+MAX_BLOCK_SIZE = 200
+
+# poll interval in seconds for datapoints without an 'interval'
+DEFAULT_INTERVAL = 15
+
+# Adaptive polling: datapoints with 'minInterval'/'maxInterval' are polled about once per 'step'
+# change of their value. Faster changes shorten the interval right away, flat values stretch it
+# by up to STRETCH_FACTOR per read, while the observed rate of change decays with RATE_DECAY.
+DEFAULT_STEP = 1.0
+STRETCH_FACTOR = 1.5
+RATE_DECAY = 0.5
+
+# Circuit breaker: a block which failed BREAKER_THRESHOLD times in a row (no reply after all tries or
+# an ErrorMessage) is not polled anymore, but probed with a single try every BREAKER_PROBE_INTERVAL
+# seconds. The interval doubles with every failed probe, up to BREAKER_MAX_PROBE_INTERVAL.
+BREAKER_THRESHOLD = 3
+BREAKER_PROBE_INTERVAL = 300
+BREAKER_MAX_PROBE_INTERVAL = 3600
+
+class Datapoint():
+    """A datapoint of the poll list (a readCmds entry), compiled once at startup.
+
+    decode(data) turns the bytes of the datapoint into its value string and fields(value) turns
+    that into the (JSON name, JSON value) pairs to publish. encode(value) is the inverse of decode
+    for writable datapoints and None for the others. history is the number of entries of an error
+    history, which starts with the datapoint as its newest entry, see ErrorHistory.py.
+    """
+    __slots__ = ('name', 'jsonname', 'fc', 'addr', 'size', 'unitSuffix', 'interval', 'minInterval', 'maxInterval', 'step', 'deadband', 'history', 'decode', 'fields', 'encode')
+
+    def __init__(self, cmd, jsonname, decode, fields, encode=None):
+        self.name = cmd['name']
+        self.jsonname = jsonname
+        self.fc = cmd.get('cmd', FunctionCodes.Virtual_READ)
+        self.addr = cmd['addr']
+        self.size = cmd['size']
+        self.unitSuffix = ' ' + cmd['unit'] if 'unit' in cmd else ''
+        self.interval = cmd.get('interval', DEFAULT_INTERVAL)
+        self.minInterval = cmd.get('minInterval', self.interval)
+        self.maxInterval = cmd.get('maxInterval', self.interval)
+        self.step = cmd.get('step', DEFAULT_STEP)
+        self.deadband = cmd.get('deadband', 0)
+        self.history = cmd.get('history', 0)
+        self.decode = decode
+        self.fields = fields
+        self.encode = encode
+
+    def __str__(self):
+        return '%04x:%02x - %s' % (self.addr, self.size, self.name)
+
+class ReadBlock():
+    def __init__(self, fc, addr, size, interval=DEFAULT_INTERVAL, minInterval=None, maxInterval=None):
+        self.fc = fc
+        self.addr = addr
+        self.size = size
+        self.interval = interval
+        self.minInterval = interval if minInterval is None else minInterval
+        self.maxInterval = interval if maxInterval is None else maxInterval
+        self.due = 0
+        self.rate = 0 # changes by 'step' per second
+        self.lastValues = {}
+        self.failures = 0 # failed reads in a row
+        self.probeInterval = 0 # > 0 while the circuit breaker is open
+        self.cmds = []
+
+    def slice(self, data, dp):
+        # the bytes of one datapoint within the block reply
+        start = dp.addr - self.addr
+        return data[start:start + dp.size]
+
+    def adapt(self, values, now):
+        # adjusts the interval to the rate of change of the decoded (datapoint, value) pairs of a read
+        if self.minInterval == self.maxInterval:
+            return
+        rates = []
+        for dp, value in values:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue # not a numeric value
+            last = self.lastValues.get(dp)
+            self.lastValues[dp] = (now, value)
+            if last and now > last[0]:
+                rates.append(abs(value - last[1]) / (now - last[0]) / dp.step)
+        if not rates:
+            return
+        self.rate = max(max(rates), self.rate * RATE_DECAY)
+        target = 1 / self.rate if self.rate > 0 else self.maxInterval
+        if target > self.interval:
+            target = min(target, self.interval * STRETCH_FACTOR)
+        self.interval = min(self.maxInterval, max(self.minInterval, target))
+
+    def merged(self):
+        # True if the block reads more than one datapoint address
+        return any(dp.addr != self.addr or dp.size != self.size for dp in self.cmds)
+
+    def succeeded(self):
+        self.failures = 0
+        self.probeInterval = 0
+
+    def failed(self):
+        # counts a failed read, returns True if the circuit breaker opened
+        self.failures += 1
+        if self.probeInterval:
+            self.probeInterval = min(2 * self.probeInterval, BREAKER_MAX_PROBE_INTERVAL)
+        elif self.failures >= BREAKER_THRESHOLD:
+            self.probeInterval = BREAKER_PROBE_INTERVAL
+            return True
+        return False
+
+    def __str__(self):
+        return '%s 0x%04x %d:%s' % (self.fc, self.addr, self.size, ','.join(dp.name for dp in self.cmds))
+
+def planReads(datapoints, maxBlockSize=MAX_BLOCK_SIZE, maxGap=0):
+    """Merges the datapoints into as few read requests as possible.
+
+    Datapoints reading the same or overlapping addresses share a request, adjacent ones are
+    merged as long as the block does not grow beyond maxBlockSize. maxGap allows to also read
+    over up to maxGap unrequested bytes between two datapoints, which only works if the unit
+    allows reading these addresses. Only datapoints with the same poll intervals are merged.
+    """
+    blocks = []
+    groups = {}
+    for dp in datapoints:
+        groups.setdefault((dp.fc, dp.interval, dp.minInterval, dp.maxInterval), []).append(dp)
+    for (fc, interval, minInterval, maxInterval), groupDatapoints in groups.items():
+        block = None
+        for dp in sorted(groupDatapoints, key=lambda dp: (dp.addr, -dp.size)):
+            end = dp.addr + dp.size
+            if block and dp.addr <= block.addr + block.size + maxGap and max(end, block.addr + block.size) - block.addr <= maxBlockSize:
+                block.size = max(end, block.addr + block.size) - block.addr
+            else:
+                block = ReadBlock(fc, dp.addr, dp.size, interval, minInterval, maxInterval)
+                blocks.append(block)
+            block.cmds.append(dp)
+    return blocks
+
+def splitBlock(plan, block):
+    # replaces a merged block, which the unit refused, by one request per datapoint
+    single = {}
+    for dp in block.cmds:
+        key = (dp.addr, dp.size)
+        if key not in single:
+            single[key] = ReadBlock(block.fc, dp.addr, dp.size, block.interval, block.minInterval, block.maxInterval)
+        single[key].cmds.append(dp)
+    index = plan.index(block)
+    return plan[:index] + list(single.values()) + plan[index + 1:]
+
+class PollScheduler():
+    """Hands out the read blocks in the order they are due.
+
+    Every block is due again interval seconds after it was due the last time. If the link
+    can't keep up, the most overdue block is handed out first and read as soon as the link
+    is free, without waiting for a fixed cycle.
+    """
+    def __init__(self, blocks):
+        self.queue = [] # heap of (due, sequence number, block)
+        self.sequence = itertools.count()
+        now = time.monotonic()
+        for block in blocks:
+            self.schedule(block, now)
+
+    def schedule(self, block, due):
+        block.due = due
+        heapq.heappush(self.queue, (due, next(self.sequence), block))
+
+    def waitTime(self):
+        # seconds till the next block is due, 0 if it is already overdue
+        if not self.queue:
+            return DEFAULT_INTERVAL
+        return max(0, self.queue[0][0] - time.monotonic())
+
+    def overdue(self):
+        # number of blocks which are due
+        now = time.monotonic()
+        return sum(1 for due, _, _ in self.queue if due <= now)
+
+    def pop(self):
+        return heapq.heappop(self.queue)[2]
+
+    def reschedule(self, block):
+        if block.probeInterval:
+            self.schedule(block, time.monotonic() + block.probeInterval)
+        else:
+            self.schedule(block, max(block.due + block.interval, time.monotonic()))
+
+    def broken(self):
+        # number of blocks with an open circuit breaker
+        return sum(1 for _, _, block in self.queue if block.probeInterval)
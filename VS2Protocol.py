@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import binascii
+import enum
+import functools
+import time
+from OptolinkMetrics import registry
+from OptolinkTrace import tracer
+
+# VS2 protocol (see VitosoftCommunication.md) shared by Viessmann2MQTT.py, VitosoftWLANServer.py
+# and other gateways: message format, a streaming frame decoder and the blocking send/receive path.
+
+VS2_DAP_STANDARD = 0x41
+
+class ReceiveState(enum.IntEnum):
+    unknown = 0
+    ENQ = 1
+    ACK = 2
+    NACK = 3
+class ProtocolIdentifier(enum.IntEnum):
+    LDAP = 0
+    RDAP = 0x10
+class MessageIdentifier(enum.IntEnum):
+    RequestMessage = 0
+    ResponseMessage = 1
+    UNACKDMessage = 2
+    ErrorMessage = 3
+class FunctionCodes(enum.IntEnum):
+    undefined = 0
+    Virtual_READ = 1
+    Virtual_WRITE = 2
+    Physical_READ = 3
+    Physical_WRITE = 4
+    EEPROM_READ = 5
+    EEPROM_WRITE = 6
+    Remote_Procedure_Call = 7
+    Virtual_MBUS = 33
+    Virtual_MarktManager_READ = 34
+    Virtual_MarktManager_WRITE = 35
+    Virtual_WILO_READ = 36
+    Virtual_WILO_WRITE = 37
+    XRAM_READ = 49
+    XRAM_WRITE = 50
+    Port_READ = 51
+    Port_WRITE = 52
+    BE_READ = 53
+    BE_WRITE = 54
+    KMBUS_RAM_READ = 65
+    KMBUS_EEPROM_READ = 67
+    KBUS_DATAELEMENT_READ = 81
+    KBUS_DATAELEMENT_WRITE = 82
+    KBUS_DATABLOCK_READ = 83
+    KBUS_DATABLOCK_WRITE = 84
+    KBUS_TRANSPARENT_READ = 85
+    KBUS_TRANSPARENT_WRITE = 86
+    KBUS_INITIALISATION_READ = 87
+    KBUS_INITIALISATION_WRITE = 88
+    KBUS_EEPROM_LT_READ = 89
+    KBUS_EEPROM_LT_WRITE = 90
+    KBUS_CONTROL_WRITE = 91
+    KBUS_MEMBERLIST_READ = 93
+    KBUS_MEMBERLIST_WRITE = 94
+    KBUS_VIRTUAL_READ = 95
+    KBUS_VIRTUAL_WRITE = 96
+    KBUS_DIRECT_READ = 97
+    KBUS_DIRECT_WRITE = 98
+    KBUS_INDIRECT_READ = 99
+    KBUS_INDIRECT_WRITE = 100
+    KBUS_GATEWAY_READ = 101
+    KBUS_GATEWAY_WRITE = 102
+    PROZESS_WRITE = 120
+    PROZESS_READ = 123
+    OT_Physical_Read = 180
+    OT_Virtual_Read = 181
+    OT_Physical_Write = 182
+    OT_Virtual_Write = 183
+    GFA_READ = 201
+    GFA_WRITE = 202
+
+class VS2Message():
+    """A VS2 message, either parsed from the received bytes or built from its fields.
+
+    A parsed message does not copy the received bytes: msgBytes and Data are views into them,
+    so a message received with a VS2FrameDecoder is only valid till the next message is
+    received with that decoder. It only keeps msgBytes, Data is a new view on every access.
+    """
+    __slots__ = ('protocol', 'identifier', 'Command', 'ADDR', 'BlockSize', 'payload', 'msgBytes')
+
+    def __init__(self, *args, **kwargs):
+        if len(args) == 1:
+            self.msgBytes = args[0] if isinstance(args[0], memoryview) else memoryview(args[0])
+            #print("VS2Message(%s)" % binascii.hexlify(self.msgBytes))
+            self.protocol = ProtocolIdentifier(self.msgBytes[0] & 0xF0)
+            self.identifier = MessageIdentifier(self.msgBytes[0] & 0x0F)
+            self.Command = FunctionCodes(self.msgBytes[1])
+            self.ADDR = (self.msgBytes[2] << 8) + self.msgBytes[3]
+            self.BlockSize = self.msgBytes[4]
+            self.payload = None
+        else:
+            self.protocol = args[0]
+            self.identifier = args[1]
+            self.Command = args[2]
+            self.ADDR = args[3]
+            self.BlockSize = args[4]
+            if len(args) > 5:
+                self.payload = args[5]
+            else:
+                self.payload = None
+
+            buf = bytearray((VS2_DAP_STANDARD, 5, self.protocol | self.identifier, self.Command, self.ADDR >> 8, self.ADDR & 0xFF, self.BlockSize))
+            if self.payload:
+                buf += self.payload
+                buf[1] += len(self.payload)
+            buf.append(sum(buf[1:]) & 0xFF)
+            self.msgBytes = bytes(buf)
+            #print("VS2Message(%s)" % binascii.hexlify(self.msgBytes))
+
+    @property
+    def Data(self):
+        if self.payload is None and isinstance(self.msgBytes, memoryview): # parsed
+            return self.msgBytes[5:]
+        return self.payload
+
+    def __str__(self):
+        if self.Data:
+            str = '%s' % self.Data.hex()
+        else:
+            str = ''
+        return f'%s %s %s 0x%04x %d:%s' % (self.protocol, self.identifier, self.Command, self.ADDR, self.BlockSize, str)
+
+@functools.lru_cache(maxsize=None)
+def requestMessage(fc, addr, size):
+    # request messages never change, so each one is only built once and then reused
+    return VS2Message(ProtocolIdentifier.LDAP, MessageIdentifier.RequestMessage, fc, addr, size)
+
+MAX_FRAME_SIZE = 2 + 255 + 1 # VS2_DAP_STANDARD, length, message, checksum
+
+class DecoderEvent(enum.IntEnum):
+    ENQ = 1
+    ACK = 2
+    NACK = 3
+    FRAME = 4
+    CHECKSUM_ERROR = 5
+
+class VS2FrameDecoder():
+    """Incremental decoder for the byte stream coming from the unit.
+
+    feed() accepts chunks of any size and yields (DecoderEvent, data) tuples. For FRAME events
+    data is a memoryview of the complete frame (VS2_DAP_STANDARD up to and including the
+    checksum). It points into the receive buffer and is only valid till the next event is
+    requested from the generator, copy it if it has to be kept. Bytes which can't start a
+    frame or are not a control byte are skipped till the next VS2_DAP_STANDARD.
+    """
+    def __init__(self, bufferSize=4 * MAX_FRAME_SIZE):
+        self.buf = bytearray(bufferSize)
+        self.view = memoryview(self.buf)
+        self.start = 0 # read offset
+        self.end = 0 # write offset
+        self.droppedBytes = 0
+        self.enqCount = 0 # an ENQ outside the handshake means the unit dropped the session
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def inFrame(self):
+        return self.start < self.end and self.buf[self.start] == VS2_DAP_STANDARD
+
+    def missing(self):
+        # number of bytes to complete the current frame, 1 if no frame has been started
+        available = self.end - self.start
+        if available < 2 or self.buf[self.start] != VS2_DAP_STANDARD:
+            return 1
+        return max(1, self.buf[self.start + 1] + 3 - available)
+
+    def feed(self, data):
+        data = memoryview(data)
+        while len(data):
+            if self.start == self.end:
+                self.start = self.end = 0
+            elif self.end == len(self.buf):
+                # compact: move the incomplete frame to the front of the buffer
+                size = self.end - self.start
+                self.buf[0:size] = self.view[self.start:self.end]
+                self.start, self.end = 0, size
+            count = min(len(data), len(self.buf) - self.end)
+            self.buf[self.end:self.end + count] = data[:count]
+            self.end += count
+            data = data[count:]
+            yield from self._parse()
+
+    def _parse(self):
+        buf = self.buf
+        while self.start < self.end:
+            b = buf[self.start]
+            if b == 0x05: # ENQ
+                self.start += 1
+                self.enqCount += 1
+                yield DecoderEvent.ENQ, None
+            elif b == 0x06: # VS2_ACK
+                self.start += 1
+                yield DecoderEvent.ACK, None
+            elif b == 0x15: # VS2_NACK
+                self.start += 1
+                yield DecoderEvent.NACK, None
+            elif b == VS2_DAP_STANDARD:
+                if self.end - self.start < 2:
+                    return
+                size = buf[self.start + 1]
+                if size < 5: # too short for a message header, can't be a frame start
+                    self.start += 1
+                    self.droppedBytes += 1
+                    continue
+                frameEnd = self.start + size + 3
+                if frameEnd > self.end:
+                    return
+                frame = self.view[self.start:frameEnd]
+                if sum(frame[1:-1]) & 0xFF != frame[-1]:
+                    self.start += 1 # resync on the next VS2_DAP_STANDARD
+                    self.droppedBytes += 1
+                    frame.release()
+                    yield DecoderEvent.CHECKSUM_ERROR, None
+                    continue
+                self.start = frameEnd
+                yield DecoderEvent.FRAME, frame
+                frame.release()
+            else:
+                self.start += 1
+                self.droppedBytes += 1
+
+# Timeouts of the receive path. Vitosoft waits 30x100ms for a reply, but instead of
+# polling in 100ms ticks, we block in the serial read till the expected bytes are in.
+# 4800 8E2 => 12 bits per byte => 2.5ms per byte, a gap of 100ms means the unit stopped sending.
+RESPONSE_TIMEOUT = 3.0
+INTER_BYTE_TIMEOUT = 0.1
+BYTE_TIME = 12 / 4800
+
+# Adaptive timeouts: the time to transfer the request and the reply at 4800 baud plus a margin for
+# the response time of the unit, which is estimated from the observed replies like the TCP
+# retransmission timeout (RFC 6298): smoothed value + 4x its mean deviation.
+MIN_TIMEOUT_MARGIN = 0.1
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+
+def transferTime(message):
+    # request + ACK + reply frame, a write request is answered without data
+    replyData = 0 if message.Data else message.BlockSize
+    return (len(message.msgBytes) + 1 + 2 + 5 + replyData + 1) * BYTE_TIME
+
+class ResponseTimer():
+    """Derives the reply timeout of a request from its expected transfer time and the observed
+    response time of the unit. Till the first reply is observed, maxTimeout is used. Every retry
+    doubles the timeout, up to maxTimeout.
+    """
+    def __init__(self, maxTimeout=RESPONSE_TIMEOUT, minMargin=MIN_TIMEOUT_MARGIN):
+        self.maxTimeout = maxTimeout
+        self.minMargin = minMargin
+        self.srtt = None # smoothed response time of the unit, without the transfer time
+        self.rttvar = 0
+
+    def observe(self, message, elapsed):
+        sample = max(0, elapsed - transferTime(message))
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - sample)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * sample
+
+    def timeout(self, message, attempt=0):
+        if self.srtt is None:
+            return self.maxTimeout
+        timeout = transferTime(message) + max(self.minMargin, self.srtt + 4 * self.rttvar)
+        return min(self.maxTimeout, timeout * 2 ** attempt)
+
+def readBytes(ser, size, deadline, interByteTimeout=None):
+    # blocking read of up to size bytes, returns early as soon as all bytes are received
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return bytes()
+    ser.timeout = remaining
+    ser.inter_byte_timeout = interByteTimeout
+    return ser.read(size)
+
+# The exchanges with the unit are generators, which yield the I/O steps below and get the read bytes
+# sent back, so the blocking functions of this module and the asyncio sessions of OptolinkAsync.py
+# share the same protocol code.
+RESET = 0 # (RESET,) drop the received bytes
+WRITE = 1 # (WRITE, data)
+READ = 2 # (READ, size, deadline, interByteTimeout) read up to size bytes
+
+def runSteps(ser, steps):
+    # runs an exchange with blocking I/O and returns its result
+    try:
+        step = next(steps)
+        while True:
+            if step[0] == READ:
+                step = steps.send(readBytes(ser, step[1], step[2], step[3]))
+            elif step[0] == WRITE:
+                ser.write(step[1])
+                step = steps.send(None)
+            else:
+                ser.reset_input_buffer()
+                step = steps.send(None)
+    except StopIteration as e:
+        return e.value
+
+def handshakeSteps(timeout, decoder, metrics=registry):
+    decoder.reset()
+    #print("SEND EOT")
+    yield (RESET,)
+    yield (WRITE, binascii.unhexlify('04'))
+    sendStart = False
+    deadline = time.monotonic() + timeout
+    while True:
+        buf = yield (READ, 1, deadline, None)
+        if len(buf) != 1:
+            metrics.inc('optolink_handshakes_total', result='failed')
+            return False
+        for event, _ in decoder.feed(buf):
+            if event == DecoderEvent.ENQ:
+                #print("RECEIVED ENQ")
+                #print("SEND VS2_START_VS2")
+                yield (WRITE, binascii.unhexlify('160000'))
+                sendStart = True
+                deadline = time.monotonic() + timeout
+            elif sendStart:
+                if event == DecoderEvent.ACK:
+                    #print("RECEIVED VS2_ACK")
+                    metrics.inc('optolink_handshakes_total', result='ok')
+                    return True
+                elif event == DecoderEvent.NACK:
+                    #print("RECEIVED VS2_NACK")
+                    #print("SEND VS2_START_VS2")
+                    yield (WRITE, binascii.unhexlify('160000'))
+                    sendStart = True
+                    deadline = time.monotonic() + timeout
+
+def startCommunication(ser, timeout=RESPONSE_TIMEOUT, decoder=None, metrics=registry):
+    if decoder is None:
+        decoder = VS2FrameDecoder()
+    return runSteps(ser, handshakeSteps(timeout, decoder, metrics))
+
+def traceRequest(message, sent, start, firstByte, result):
+    # spans of one request: writing it, waiting for the first reply byte and receiving the reply
+    end = time.monotonic()
+    tracer.complete('request 0x%04x' % message.ADDR, sent, end, fc=message.Command.name, size=message.BlockSize, result=result)
+    tracer.complete('send', sent, start, bytes=len(message.msgBytes))
+    if firstByte is not None:
+        tracer.complete('wait for reply', start, firstByte)
+        tracer.complete('receive', firstByte, end)
+    else:
+        tracer.complete('wait for reply', start, end)
+
+def exchangeSteps(message, timeout, interByteTimeout, decoder, metrics=registry):
+    decoder.reset()
+    addr = '0x%04x' % message.ADDR
+    tracing = tracer.enabled
+    if tracing:
+        sent = time.monotonic()
+        firstByte = None
+        dropped = decoder.droppedBytes
+    #print("SEND %s" % binascii.hexlify(message.msgBytes))
+    yield (WRITE, message.msgBytes)
+    start = time.monotonic()
+    deadline = start + timeout
+    receiveStatus = ReceiveState.unknown
+    while True:
+        # an ACK or NACK is expected first (older ones are dropped), then the frame follows back-to-back
+        buf = yield (READ, decoder.missing(), deadline, interByteTimeout if decoder.inFrame() else None)
+        if not len(buf):
+            metrics.inc('optolink_timeouts_total', addr=addr)
+            if tracing:
+                traceRequest(message, sent, start, firstByte, 'timeout')
+            return None
+        if tracing and firstByte is None:
+            firstByte = time.monotonic()
+        for event, frame in decoder.feed(buf):
+            if tracing and decoder.droppedBytes != dropped: # garbage before this event
+                tracer.instant('resync', addr=addr, droppedBytes=decoder.droppedBytes - dropped)
+                dropped = decoder.droppedBytes
+            if event == DecoderEvent.ACK:
+                receiveStatus = ReceiveState.ACK
+            elif event == DecoderEvent.NACK:
+                receiveStatus = ReceiveState.NACK
+                metrics.inc('optolink_nacks_total', addr=addr)
+                if tracing:
+                    tracer.instant('NACK', addr=addr)
+            elif event == DecoderEvent.ENQ: # the unit is waiting for a new session, no reply will come
+                if tracing:
+                    traceRequest(message, sent, start, firstByte, 'ENQ')
+                return None
+            elif event == DecoderEvent.CHECKSUM_ERROR:
+                metrics.inc('optolink_checksum_errors_total', addr=addr)
+                if tracing:
+                    traceRequest(message, sent, start, firstByte, 'checksum error')
+                return None
+            elif event == DecoderEvent.FRAME:
+                msg = None
+                if receiveStatus == ReceiveState.ACK:
+                    msg = VS2Message(frame[2:-1])
+                    if msg.identifier == MessageIdentifier.ErrorMessage:
+                        metrics.inc('optolink_error_messages_total', addr=addr)
+                    else:
+                        metrics.observe('optolink_request_seconds', time.monotonic() - start, addr=addr)
+                yield (WRITE, binascii.unhexlify('06')) # VS2_ACK
+                if tracing:
+                    traceRequest(message, sent, start, firstByte, 'NACK' if msg is None else msg.identifier.name)
+                return msg
+        if tracing and decoder.droppedBytes != dropped: # garbage at the end of the chunk
+            tracer.instant('resync', addr=addr, droppedBytes=decoder.droppedBytes - dropped)
+            dropped = decoder.droppedBytes
+
+def sendVS2Message(ser, message, timeout=RESPONSE_TIMEOUT, interByteTimeout=INTER_BYTE_TIMEOUT, decoder=None, metrics=registry):
+    if decoder is None:
+        decoder = VS2FrameDecoder()
+    return runSteps(ser, exchangeSteps(message, timeout, interByteTimeout, decoder, metrics))
@@ -2,13 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import asyncio
 import time
 import os
 import serial
-import binascii
-import enum
 from datetime import datetime
 import struct
+import functools
+import json
+from ErrorHistory import ErrorHistory
+from MQTTPublisher import ChangePublisher
+from OptolinkAsync import AsyncMQTTClient, AsyncSerial, AsyncVS2Session
+from OptolinkMetrics import CYCLE_BUCKETS, registry, serveMetrics
+from OptolinkTrace import NULL_SPAN, tracer
+from VS2Poller import Datapoint, PollScheduler, planReads, splitBlock
+from VS2Protocol import MessageIdentifier, FunctionCodes, ProtocolIdentifier, VS2Message, requestMessage
 import paho.mqtt.client as mqtt
 import logging
 import logging.handlers
@@ -20,13 +28,80 @@ MQTT_USER = "mqtt username"
 MQTT_PASSWORD = "mqtt password"
 MQTT_SERVER = 'mqtt server name or IP'
 MQTT_TOPIC = 'Viessmann'
+SERIAL_PORT = '/dev/ttyUSB0' # or socket://host:port, e.g. for the OptolinkSimulator.py
+
+# Datapoints with neighbouring addresses are read with one request of up to MAX_BLOCK_SIZE bytes.
+# MAX_BLOCK_GAP > 0 also reads over unrequested bytes, if the unit allows that.
+MAX_BLOCK_SIZE = 200
+MAX_BLOCK_GAP = 0
+
+# A read is tried up to READ_TRIES times, with a pause of RETRY_BACKOFF seconds before the first retry,
+# which doubles with every further retry. Blocks which fail repeatedly are only probed from time to
+# time, see the circuit breaker in VS2Poller.py.
+READ_TRIES = 5
+RETRY_BACKOFF = 0.05
+
+# Poll intervals in seconds, each datapoint has its own with 'interval'
+POLL_FAST = 5 # temperatures and other values which change quickly
+POLL_NORMAL = 60 # counters, operating hours, setpoints
+POLL_SLOW = 600 # error history
+POLL_STATIC = 3600 # ID, coding addresses and switching times
+
+# Adaptive polling: the numeric datapoints of these tiers are polled faster while their value moves
+# by more than 'step' per interval (default 1, 0.5 for temperatures) and slower while it is flat.
+ADAPTIVE_INTERVALS = { POLL_FAST:(2,60), POLL_NORMAL:(15,600) }
+
+# Every datapoint is published to its own topic status/<name>, as a JSON value, if it changed by more
+# than its 'deadband' (0.2 for temperatures), and at least every PUBLISH_REFRESH seconds.
+# PUBLISH_JSON additionally publishes all datapoints as one JSON object to status/json.
+PUBLISH_TOPICS = True
+PUBLISH_JSON = True
+PUBLISH_REFRESH = 600
+
+# Link and poller metrics (latency per address, retries, NACKs, ...) are served for Prometheus on
+# http://<host>:METRICS_PORT/metrics and published as JSON to metrics every METRICS_PUBLISH seconds.
+# None or 0 disables them.
+METRICS_PORT = 9101
+METRICS_PUBLISH = 60
+
+# Spans of the handshake, the cycles, every request, decoding and publishing are written to TRACE_FILE
+# in the Chrome trace format (open it with https://ui.perfetto.dev), rotated after TRACE_MAX_BYTES.
+# None disables the tracing.
+TRACE_FILE = None # e.g. '/tmp/Viessmann2MQTT.trace.json'
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+
+# Datapoints with 'write':True are set by publishing the new value to set/<name>, e.g. 48 to
+# Viessmann/set/Warmwasser_Solltemperatur. Values outside of 'min' and 'max' are rejected. Writes
+# take priority over the polling: they are sent between two reads, then the datapoint is read back
+# and published right away. At most WRITE_QUEUE_SIZE writes wait per link.
+WRITE_QUEUE_SIZE = 16
+
+# Error histories: datapoints with 'history' are the newest entry of a ring of that many entries. When
+# it changed, the whole ring is read with one request and published as JSON list to history/<name>,
+# the faults which were not in it before go to events/<name>, not retained. ERROR_HISTORY enables it.
+# The ring is also read when ecnsysEventType-ErrorIndex at ERROR_INDEX_ADDR changed and at least every
+# HISTORY_REFRESH seconds, in case the unit writes a new fault to another slot than the first one.
+# Without ERROR_HISTORY, every entry is polled as its own datapoint '<name> <slot>' every POLL_SLOW.
+ERROR_HISTORY = True
+ERROR_INDEX_ADDR = 0x7561
+HISTORY_REFRESH = POLL_SLOW
 
 if not MQTT_TOPIC.endswith("/"):
     MQTT_TOPIC+="/"
 
+# Several units can be polled by one process, every link with its own serial port, topic and poll list
+# ('readCmds', default is the readCmds below). The links share the MQTT connection and the metrics,
+# which are labelled with the link name. A link which fails is restarted after LINK_RESTART_DELAY
+# seconds, without affecting the other links.
+LINKS = [
+    {'name':'Viessmann', 'port':SERIAL_PORT, 'topic':MQTT_TOPIC},
+    # {'name':'Vitola', 'port':'/dev/ttyUSB1', 'topic':'Vitola/'},
+]
+LINK_RESTART_DELAY = 30
+
 scriptPathAndName = None
 lastModDate = None
-def wait100ms():
+def checkRelaunch():
     global scriptPathAndName,lastModDate
     if not scriptPathAndName:
         scriptPathAndName = os.path.realpath(__file__)
@@ -36,211 +111,20 @@ def wait100ms():
         print ('#### RELAUNCH ####')
         os.execv(sys.argv[0], sys.argv)
         sys.exit(0)
-    time.sleep(0.1)
 
-ser = serial.Serial(port='/dev/ttyUSB0', baudrate=4800, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_TWO, bytesize=serial.EIGHTBITS)
+def linkTopic(link):
+    return link['topic'] if link['topic'].endswith('/') else link['topic'] + '/'
 
 def connecthandler(mqc,userdata,flags,rc):
     logging.info("Connected to MQTT broker with rc=%d" % (rc))
     mqc.publish(MQTT_TOPIC+"connected",True,qos=1,retain=True)
+    for link in LINKS:
+        mqc.subscribe(linkTopic(link) + 'set/+')
 
 def disconnecthandler(mqc,userdata,rc):
     logging.warning("Disconnected from MQTT broker with rc=%d" % (rc))
 
 
-def startCommunication():
-    #print("SEND EOT")
-    ser.flush()
-    ser.write(binascii.unhexlify('04'))
-    sendStart = False
-    t = 0
-    while t < 3000:
-        #print("... %.1fms" % (t*0.001))
-        if ser.in_waiting:
-            buf = ser.read()
-            if len(buf) == 1:
-                if buf[0] == 0x05:
-                    #print("RECEIVED ENQ")
-                    #print("SEND VS2_START_VS2")
-                    ser.write(binascii.unhexlify('160000'))
-                    sendStart = True
-                    t = 0
-                elif sendStart:
-                    if buf[0] == 0x06: # VS2_ACK
-                        #print("RECEIVED VS2_ACK")
-                        return True
-                    elif buf[0] == 0x15: # VS2_NACK
-                        #print("RECEIVED VS2_NACK")
-                        #print("SEND VS2_START_VS2")
-                        ser.write(binascii.unhexlify('160000'))
-                        sendStart = True
-                        t = 0
-                    else:
-                        #print("RECEIVED %s" % binascii.hexlify(buf))
-                        pass
-            else:
-                #print("RECEIVED %s" % binascii.hexlify(buf))
-                pass
-        wait100ms()
-        t += 100
-    return False
-
-class ReceiveState(enum.IntEnum):
-    unknown = 0
-    ENQ = 1
-    ACK = 2
-    NACK = 3
-class ProtocolIdentifier(enum.IntEnum):
-    LDAP = 0
-    RDAP = 0x10
-class MessageIdentifier(enum.IntEnum):
-    RequestMessage = 0
-    ResponseMessage = 1
-    UNACKDMessage = 2
-    ErrorMessage = 3
-class FunctionCodes(enum.IntEnum):
-    undefined = 0
-    Virtual_READ = 1
-    Virtual_WRITE = 2
-    Physical_READ = 3
-    Physical_WRITE = 4
-    EEPROM_READ = 5
-    EEPROM_WRITE = 6
-    Remote_Procedure_Call = 7
-    Virtual_MBUS = 33
-    Virtual_MarktManager_READ = 34
-    Virtual_MarktManager_WRITE = 35
-    Virtual_WILO_READ = 36
-    Virtual_WILO_WRITE = 37
-    XRAM_READ = 49
-    XRAM_WRITE = 50
-    Port_READ = 51
-    Port_WRITE = 52
-    BE_READ = 53
-    BE_WRITE = 54
-    KMBUS_RAM_READ = 65
-    KMBUS_EEPROM_READ = 67
-    KBUS_DATAELEMENT_READ = 81
-    KBUS_DATAELEMENT_WRITE = 82
-    KBUS_DATABLOCK_READ = 83
-    KBUS_DATABLOCK_WRITE = 84
-    KBUS_TRANSPARENT_READ = 85
-    KBUS_TRANSPARENT_WRITE = 86
-    KBUS_INITIALISATION_READ = 87
-    KBUS_INITIALISATION_WRITE = 88
-    KBUS_EEPROM_LT_READ = 89
-    KBUS_EEPROM_LT_WRITE = 90
-    KBUS_CONTROL_WRITE = 91
-    KBUS_MEMBERLIST_READ = 93
-    KBUS_MEMBERLIST_WRITE = 94
-    KBUS_VIRTUAL_READ = 95
-    KBUS_VIRTUAL_WRITE = 96
-    KBUS_DIRECT_READ = 97
-    KBUS_DIRECT_WRITE = 98
-    KBUS_INDIRECT_READ = 99
-    KBUS_INDIRECT_WRITE = 100
-    KBUS_GATEWAY_READ = 101
-    KBUS_GATEWAY_WRITE = 102
-    PROZESS_WRITE = 120
-    PROZESS_READ = 123
-    OT_Physical_Read = 180
-    OT_Virtual_Read = 181
-    OT_Physical_Write = 182
-    OT_Virtual_Write = 183
-    GFA_READ = 201
-    GFA_WRITE = 202
-
-class VS2Message():
-    protocol = ProtocolIdentifier.LDAP
-    identifier = MessageIdentifier.RequestMessage
-    Command = FunctionCodes.undefined
-    ADDR = 0
-    Data = bytes()
-    msgBytes = bytes()
-
-    def __init__(self, *args, **kwargs):
-        if len(args) == 1:
-            self.msgBytes = args[0]
-            #print("VS2Message(%s)" % binascii.hexlify(self.msgBytes))
-            self.protocol = ProtocolIdentifier(self.msgBytes[0] & 0xF0)
-            self.identifier = MessageIdentifier(self.msgBytes[0] & 0x0F)
-            self.Command = FunctionCodes(self.msgBytes[1])
-            self.ADDR = (self.msgBytes[2] << 8) + self.msgBytes[3]
-            self.BlockSize = self.msgBytes[4]
-            self.Data = self.msgBytes[5:]
-        else:
-            self.protocol = args[0]
-            self.identifier = args[1]
-            self.Command = args[2]
-            self.ADDR = args[3]
-            self.BlockSize = args[4]
-            if len(args) > 5:
-                self.Data = args[5]
-            else:
-                self.Data = None
-
-            buf = bytearray([self.protocol.value | self.identifier.value, self.Command.value, self.ADDR >> 8, self.ADDR & 0xFF, self.BlockSize])
-            if self.Data:
-                buf += bytearray(self.Data)
-            buf = bytearray([0x41, len(buf)]) + buf
-            buf = buf + bytearray([sum(buf[1:]) & 0xFF])
-            self.msgBytes = bytes(buf)
-            #print("VS2Message(%s)" % binascii.hexlify(self.msgBytes))
-
-    def __str__(self):
-        if self.Data:
-            str = '%s' % self.Data.hex()
-        else:
-            str = ''
-        return f'%s %s %s 0x%04x %d:%s' % (self.protocol, self.identifier, self.Command, self.ADDR, self.BlockSize, str)
-
-def sendVS2Message(message):
-    #print("SEND %s" % binascii.hexlify(message.msgBytes))
-    ser.write(message.msgBytes)
-    t = 0
-    buf = None
-    receiveStatus = ReceiveState.unknown
-    while t < 3000:
-        #print("... %.1fms" % (t*0.001))
-        if ser.in_waiting:
-            if buf == None:
-                buf = ser.read(ser.in_waiting)
-            else:
-                buf += ser.read(ser.in_waiting)
-            if len(buf):
-                if buf[0] == 0x06: # VS2_ACK
-                    if receiveStatus != ReceiveState.ACK:
-                        #print("RECEIVED VS2_ACK")
-                        pass
-                    receiveStatus = ReceiveState.ACK
-                elif buf[0] == 0x15: # VS2_NACK
-                    if receiveStatus != ReceiveState.NACK:
-                        #print("RECEIVED VS2_NACK")
-                        pass
-                    receiveStatus = ReceiveState.NACK
-                if len(buf) > 1:
-                    if receiveStatus == ReceiveState.NACK:
-                        if buf[1] == 0x06: # VS2_ACK
-                            buf = buf[1:]
-                            receiveStatus = ReceiveState.ACK
-                        elif buf[1] == 0x15: # VS2_NACK
-                            buf = buf[1:]
-                    if len(buf) > 1:
-                        if receiveStatus != ReceiveState.ACK and receiveStatus != ReceiveState.NACK:
-                            break # unknown state
-                        #print("RECEIVED %s" % binascii.hexlify(buf))
-                        if len(buf) > 3 and buf[1] == 0x41 and len(buf) == 1 + buf[2] + 3 and (sum(buf[2:-1]) & 0xff) == buf[-1]:
-                            msg = None
-                            if buf[0] == 0x06: # VS2_ACK
-                                msg = VS2Message(buf[3:-1])
-                            ser.write(binascii.unhexlify('06')) # VS2_ACK
-                            return msg
-        wait100ms()
-        t += 100
-    return None
-
-commStarted = False
-
 def errorcode(errorcode):
     errorcode_VScotHO1_72 = {
         0x00: "Anlage ohne Fehler",
@@ -362,6 +246,23 @@ def DateTimeFromBCD(data, offset):
     # data[4+offset] == weekday, 0 = Monday
     return datetime.strptime('%02x%02x-%02x-%02x %02x:%02x:%02x' % (data[0+offset],data[1+offset],data[2+offset],data[3+offset],data[5+offset],data[6+offset],data[7+offset]), '%Y-%m-%d %H:%M:%S')
 
+def errorEntry(data):
+    # an entry of an error history, None for empty slots
+    if data[0] == 0:
+        return None
+    try:
+        timestamp = DateTimeFromBCD(data, 1).isoformat(' ')
+    except ValueError:
+        timestamp = None # not a valid BCD date
+    return {'time': timestamp, 'code': '0x%02X' % data[0], 'error': errorcode(data[0])}
+
+def errorText(data):
+    # an entry of an error history as text, without the date if it is not a valid BCD date
+    try:
+        return '%s %s' % (DateTimeFromBCD(data, 1), errorcode(data[0]))
+    except ValueError:
+        return errorcode(data[0])
+
 def PhaseDay(data):
     dayStrs = []
     for dayOffset in range(0,7):
@@ -403,176 +304,427 @@ def PhaseDay(data):
         result += '%s-%s:%s' % (weekDayList[firstDay],weekDayList[currentDay-1],lastStr)
     return result.strip()
 
+INT16 = struct.Struct('<h')
+INT32 = struct.Struct('<i')
+SOLAR = struct.Struct('<8i')
+
 eventTypeConversionFunctions = {
-    'Mult2': (lambda data,offset: '%d' % (struct.unpack("<h", data[offset:offset+2])[0] * 2.0)),
-    'Mult5': (lambda data,offset: '%d' % (struct.unpack("<h", data[offset:offset+2])[0] * 5.0)),
-    'Mult10': (lambda data,offset: '%d' % (struct.unpack("<h", data[offset:offset+2])[0] * 10.0)),
-    'Mult100': (lambda data,offset: '%d' % (struct.unpack("<h", data[offset:offset+2])[0] * 100.0)),
-    'Div2': (lambda data,offset: '%.1f' % (struct.unpack("<h", data[offset:offset+2])[0] / 2.0)),
-    'Div5': (lambda data,offset: '%.1f' % (struct.unpack("<h", data[offset:offset+2])[0] / 5.0)),
-    'Div10': (lambda data,offset: '%.1f' % (struct.unpack("<h", data[offset:offset+2])[0] / 10.0)),
-    'Div100': (lambda data,offset: '%.01f' % (struct.unpack("<h", data[offset:offset+2])[0] / 10.0)),
-    'Sec2Hour': (lambda data,offset: '%.2f' % (struct.unpack("<i", data[offset:offset+4])[0] / 3600.0)),
+    'Mult2': (lambda data,offset: '%d' % (INT16.unpack_from(data, offset)[0] * 2.0)),
+    'Mult5': (lambda data,offset: '%d' % (INT16.unpack_from(data, offset)[0] * 5.0)),
+    'Mult10': (lambda data,offset: '%d' % (INT16.unpack_from(data, offset)[0] * 10.0)),
+    'Mult100': (lambda data,offset: '%d' % (INT16.unpack_from(data, offset)[0] * 100.0)),
+    'Div2': (lambda data,offset: '%.1f' % (INT16.unpack_from(data, offset)[0] / 2.0)),
+    'Div5': (lambda data,offset: '%.1f' % (INT16.unpack_from(data, offset)[0] / 5.0)),
+    'Div10': (lambda data,offset: '%.1f' % (INT16.unpack_from(data, offset)[0] / 10.0)),
+    'Div100': (lambda data,offset: '%.01f' % (INT16.unpack_from(data, offset)[0] / 10.0)),
+    'Sec2Hour': (lambda data,offset: '%.2f' % (INT32.unpack_from(data, offset)[0] / 3600.0)),
 
      'Mult100_Int8': (lambda data,offset: '%d' % (data[offset] * 100)),
      'Int8': (lambda data,offset: '%d' % (data[offset])),
-    'Int16': (lambda data,offset: '%d' % (struct.unpack("<h", data[offset:offset+2])[0])),
-    'Int32': (lambda data,offset: '%d' % (struct.unpack("<i", data[offset:offset+4])[0])),
-#    'Solar': (lambda data,offset: 'Heute:%d Wh, -1:%d Wh, -2:%d Wh, -3:%d Wh, -4:%d Wh, -5:%d Wh, -6:%d Wh, -7:%d Wh' % struct.unpack("<8i", data[offset:])),
-    'Solar': (lambda data,offset: '%d;%d;%d;%d;%d;%d;%d;%d' % struct.unpack("<8i", data[offset:])),
-    'FehlerHistory': (lambda data,offset: '"%s %s"' % (DateTimeFromBCD(data,offset+1), errorcode(data[offset]))),
+    'Int16': (lambda data,offset: '%d' % (INT16.unpack_from(data, offset)[0])),
+    'Int32': (lambda data,offset: '%d' % (INT32.unpack_from(data, offset)[0])),
+#    'Solar': (lambda data,offset: 'Heute:%d Wh, -1:%d Wh, -2:%d Wh, -3:%d Wh, -4:%d Wh, -5:%d Wh, -6:%d Wh, -7:%d Wh' % SOLAR.unpack_from(data, offset)),
+    'Solar': (lambda data,offset: '%d;%d;%d;%d;%d;%d;%d;%d' % SOLAR.unpack_from(data, offset)),
+    'FehlerHistory': (lambda data,offset: '"%s"' % errorText(data[offset:offset+9])),
     'PhaseType': (lambda data,offset: 'PhaseType(%s)' % PhaseDay(data[offset:])),
-    'DatumUhrzeit': (lambda data,offset: DateTimeFromBCD(data,offset)),
+    'DatumUhrzeit': (lambda data,offset: '%s' % DateTimeFromBCD(data,offset)),
+}
+
+# the inverse of eventTypeConversionFunctions for writable datapoints, from the value string to the bytes
+eventTypeEncodeFunctions = {
+    'Mult2': (lambda value: INT16.pack(round(float(value) / 2.0))),
+    'Mult5': (lambda value: INT16.pack(round(float(value) / 5.0))),
+    'Mult10': (lambda value: INT16.pack(round(float(value) / 10.0))),
+    'Mult100': (lambda value: INT16.pack(round(float(value) / 100.0))),
+    'Div2': (lambda value: INT16.pack(round(float(value) * 2.0))),
+    'Div5': (lambda value: INT16.pack(round(float(value) * 5.0))),
+    'Div10': (lambda value: INT16.pack(round(float(value) * 10.0))),
+    'Div100': (lambda value: INT16.pack(round(float(value) * 10.0))), # like the conversion above
+    'Sec2Hour': (lambda value: INT32.pack(round(float(value) * 3600.0))),
+
+    'Mult100_Int8': (lambda value: bytes((round(float(value) / 100),))),
+    'Int8': (lambda value: bytes((int(value),))),
+    'Int16': (lambda value: INT16.pack(int(value))),
+    'Int32': (lambda value: INT32.pack(int(value))),
 }
 
+def encodeValue(cmd, value):
+    # the bytes to write for the value string, raises ValueError, OverflowError ('inf') or struct.error for invalid values
+    number = float(value)
+    if number < cmd.get('min', number) or number > cmd.get('max', number):
+        raise ValueError('%s is out of range %s..%s' % (value, cmd.get('min'), cmd.get('max')))
+    data = eventTypeEncodeFunctions[cmd['conv']](value)
+    if len(data) != cmd['size']:
+        raise ValueError('%d bytes instead of %d' % (len(data), cmd['size']))
+    return data
+
+def rawValue(data, offset=0):
+    # datapoints without a conversion are published as hex dump
+    result = '0x%s' % data.hex()
+    if len(data) == 2:
+        result += ' %d' % (data[0] + 256 * data[1])
+    return result
+
 readCmds = [
-            { 'addr':0x00F8,'size':8, 'name':'ID' },
-            { 'addr':0x088E,'size':8,'conv':'DatumUhrzeit', 'name':'Datum und Uhrzeit' },
-
-            { 'addr':0x7700,'size':1, 'name':'(00) Heizkreis-Warmwasserschema' },
-            { 'addr':0x7701,'size':1, 'name':'(01) Anlagentyp' },
-            { 'addr':0x7754,'size':1, 'name':'(54) Solarregelung' },
-            { 'addr':0x777F,'size':1, 'name':'(7F) Unterscheidung Einfamilienhaus - Mehrparteienhaus' },
-
-            { 'addr':0x2000,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten HK A1M1' },
-            { 'addr':0x2100,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten WW A1M1' },
-            { 'addr':0x2200,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten ZP A1M1' },
-
-            { 'addr':0x3000,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten M2' },
-            { 'addr':0x3100,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten WW M2' },
-            { 'addr':0x3200,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten ZP M2' },
-
-            { 'addr':0x4000,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten M3' },
-            { 'addr':0x4100,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten WW M3' },
-            { 'addr':0x4200,'size':56,'conv':'PhaseType', 'name':'Schaltzeiten ZP M3' },
-
-            { 'addr':0x7590+9*0,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 0' },
-            { 'addr':0x7590+9*1,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 1' },
-            { 'addr':0x7590+9*2,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 2' },
-            { 'addr':0x7590+9*3,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 3' },
-            { 'addr':0x7590+9*4,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 4' },
-            { 'addr':0x7590+9*5,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 5' },
-            { 'addr':0x7590+9*6,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 6' },
-            { 'addr':0x7590+9*7,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 7' },
-            { 'addr':0x7590+9*8,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 8' },
-            { 'addr':0x7590+9*9,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 9' },
-            { 'addr':0x7590+9*10,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 10' },
-            { 'addr':0x7590+9*11,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 11' },
-            { 'addr':0x7590+9*12,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 12' },
-            { 'addr':0x7590+9*13,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 13' },
-            { 'addr':0x7590+9*14,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 14' },
-            { 'addr':0x7590+9*15,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 15' },
-            { 'addr':0x7590+9*16,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 16' },
-            { 'addr':0x7590+9*17,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 17' },
-            { 'addr':0x7590+9*18,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 18' },
-            { 'addr':0x7590+9*19,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie FA 19' },
-
-            { 'addr':0x7561,'size':10, 'name':'ecnsysEventType-ErrorIndex' },
-            { 'addr':0x7507+9*0,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 0' },
-            { 'addr':0x7507+9*1,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 1' },
-            { 'addr':0x7507+9*2,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 2' },
-            { 'addr':0x7507+9*3,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 3' },
-            { 'addr':0x7507+9*4,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 4' },
-            { 'addr':0x7507+9*5,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 5' },
-            { 'addr':0x7507+9*6,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 6' },
-            { 'addr':0x7507+9*7,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 7' },
-            { 'addr':0x7507+9*8,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 8' },
-            { 'addr':0x7507+9*9,'size':9,'conv':'FehlerHistory', 'name':'Fehlerhistorie 9' },
-
-            { 'addr':0xCF30,'size':32,'conv':'Solar', 'name':'Solarertrag' },
-            { 'addr':0x6564,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Solar Kollektortemperatur' },
-            { 'addr':0x6566,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Solar Speichertemperatur' },
-            { 'addr':0x6560,'size':2,'conv':'Int16', 'unit':'kWh', 'name':'Solar Wärmemenge' },
-            { 'addr':0x6568,'size':2,'conv':'Int16', 'unit':'Stunden', 'name':'Solar Betriebsstunden' },
-
-            { 'addr':0x7700,'size':1, 'name':'Heizkreis-Warmwasserschema' },
+            { 'addr':0x00F8,'size':8, 'interval':POLL_STATIC, 'name':'ID' },
+            { 'addr':0x088E,'size':8,'conv':'DatumUhrzeit', 'interval':POLL_NORMAL, 'name':'Datum und Uhrzeit' },
+
+            { 'addr':0x7700,'size':1, 'interval':POLL_STATIC, 'name':'(00) Heizkreis-Warmwasserschema' },
+            { 'addr':0x7701,'size':1, 'interval':POLL_STATIC, 'name':'(01) Anlagentyp' },
+            { 'addr':0x7754,'size':1, 'interval':POLL_STATIC, 'name':'(54) Solarregelung' },
+            { 'addr':0x777F,'size':1, 'interval':POLL_STATIC, 'name':'(7F) Unterscheidung Einfamilienhaus - Mehrparteienhaus' },
+
+            { 'addr':0x2000,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten HK A1M1' },
+            { 'addr':0x2100,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten WW A1M1' },
+            { 'addr':0x2200,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten ZP A1M1' },
+
+            { 'addr':0x3000,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten M2' },
+            { 'addr':0x3100,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten WW M2' },
+            { 'addr':0x3200,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten ZP M2' },
+
+            { 'addr':0x4000,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten M3' },
+            { 'addr':0x4100,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten WW M3' },
+            { 'addr':0x4200,'size':56,'conv':'PhaseType', 'interval':POLL_STATIC, 'name':'Schaltzeiten ZP M3' },
+
+            { 'addr':0x7561,'size':10, 'interval':POLL_SLOW, 'name':'ecnsysEventType-ErrorIndex' },
+            # only the newest entry of the error histories is polled, see ERROR_HISTORY
+            { 'addr':0x7507,'size':9,'conv':'FehlerHistory', 'interval':POLL_NORMAL, 'name':'Fehlerhistorie', 'history':10 },
+            { 'addr':0x7590,'size':9,'conv':'FehlerHistory', 'interval':POLL_NORMAL, 'name':'Fehlerhistorie FA', 'history':20 },
+
+            { 'addr':0xCF30,'size':32,'conv':'Solar', 'interval':POLL_NORMAL, 'name':'Solarertrag' },
+            { 'addr':0x6564,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Solar Kollektortemperatur' },
+            { 'addr':0x6566,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Solar Speichertemperatur' },
+            { 'addr':0x6560,'size':2,'conv':'Int16', 'unit':'kWh', 'interval':POLL_NORMAL, 'name':'Solar Wärmemenge' },
+            { 'addr':0x6568,'size':2,'conv':'Int16', 'unit':'Stunden', 'interval':POLL_NORMAL, 'name':'Solar Betriebsstunden' },
+
+            { 'addr':0x7700,'size':1, 'interval':POLL_STATIC, 'name':'Heizkreis-Warmwasserschema' },
 
 #           { 'addr':0x47C5,'size':1, 'name':'Vorlauf - Minimalbegrenzung M3' },
 #           { 'addr':0x47C6,'size':1, 'name':'Vorlauf - Maximalbegrenzung M3' },
 #
-            { 'addr':0x0800,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Aussentemperatur' },
-            { 'addr':0x5525,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Aussentemperatur Tiefpass' },
-            { 'addr':0x5527,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Aussentemperatur gedämpft' },
-            { 'addr':0x0810,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Kesseltemperatur' },
-            { 'addr':0x555A,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Kesselsolltemperatur' },
-            { 'addr':0x0816,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Abgastemperatur' },
+            { 'addr':0x0800,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Aussentemperatur' },
+            { 'addr':0x5525,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Aussentemperatur Tiefpass' },
+            { 'addr':0x5527,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Aussentemperatur gedämpft' },
+            { 'addr':0x0810,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Kesseltemperatur' },
+            { 'addr':0x555A,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Kesselsolltemperatur' },
+            { 'addr':0x0816,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Abgastemperatur' },
 #           { 'addr':0x0810,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Vorlauftemperatur A1M1' },
-            { 'addr':0x081A,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Gem. Vorlauftemperatur' },
-            { 'addr':0x3900,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Vorlauftemperatur M2' },
-            { 'addr':0x4900,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Vorlauftemperatur M3' },
-            { 'addr':0x0812,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Temperatur Speicher Ladesensor Komfortsensor' },
-            { 'addr':0x0814,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Auslauftemperatur' },
-            { 'addr':0x0804,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Warmwassertemperatur Ist' },
-            { 'addr':0x6500,'size':2,'conv':'Div10', 'unit':'℃', 'name':'Warmwassertemperatur Soll (effektiv)' },
-            { 'addr':0xCF90,'size':20,'conv':'Div10','offset':6, 'unit':'℃', 'name':'Sensor 7' },
-            { 'addr':0xCF90,'size':20,'conv':'Div10','offset':8, 'unit':'℃', 'name':'Sensor 10' },
-            { 'addr':0x08A7,'size':4,'conv':'Sec2Hour', 'unit':'Stunden', 'name':'Brenner-Betriebsstunden' },
-            { 'addr':0x088A,'size':4,'conv':'Int32', 'name':'Brennerstarts' },
-            { 'addr':0x0C24,'size':2,'conv':'Int16', 'name':'Durchfluss Strömungssensor' },
-            { 'addr':0x7660,'size':2,'conv':'Int16', 'unit':'%', 'name':'Interne Pumpe Drehzahl' },
-            { 'addr':0x6300,'size':1,'conv':'Int8', 'unit':'℃', 'name':'Warmwasser-Solltemperatur' },
-            { 'addr':0x5706,'size':1,'conv':'Int8', 'unit':'℃', 'name':'Kesselmaximal-Temperatur' },
+            { 'addr':0x081A,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Gem. Vorlauftemperatur' },
+            { 'addr':0x3900,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Vorlauftemperatur M2' },
+            { 'addr':0x4900,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Vorlauftemperatur M3' },
+            { 'addr':0x0812,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Temperatur Speicher Ladesensor Komfortsensor' },
+            { 'addr':0x0814,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Auslauftemperatur' },
+            { 'addr':0x0804,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Warmwassertemperatur Ist' },
+            { 'addr':0x6500,'size':2,'conv':'Div10', 'unit':'℃', 'interval':POLL_FAST, 'name':'Warmwassertemperatur Soll (effektiv)' },
+            { 'addr':0xCF90,'size':20,'conv':'Div10','offset':6, 'unit':'℃', 'interval':POLL_FAST, 'name':'Sensor 7' },
+            { 'addr':0xCF90,'size':20,'conv':'Div10','offset':8, 'unit':'℃', 'interval':POLL_FAST, 'name':'Sensor 10' },
+            { 'addr':0x08A7,'size':4,'conv':'Sec2Hour', 'unit':'Stunden', 'interval':POLL_NORMAL, 'name':'Brenner-Betriebsstunden' },
+            { 'addr':0x088A,'size':4,'conv':'Int32', 'interval':POLL_NORMAL, 'name':'Brennerstarts' },
+            { 'addr':0x0C24,'size':2,'conv':'Int16', 'interval':POLL_FAST, 'name':'Durchfluss Strömungssensor' },
+            { 'addr':0x7660,'size':2,'conv':'Int16', 'unit':'%', 'interval':POLL_FAST, 'name':'Interne Pumpe Drehzahl' },
+            { 'addr':0x6300,'size':1,'conv':'Int8', 'unit':'℃', 'interval':POLL_NORMAL, 'name':'Warmwasser-Solltemperatur', 'write':True, 'min':10, 'max':60 },
+            { 'addr':0x5706,'size':1,'conv':'Int8', 'unit':'℃', 'interval':POLL_STATIC, 'name':'Kesselmaximal-Temperatur' },
           ]
 
-try:
+for cmd in readCmds:
+    if cmd['interval'] in ADAPTIVE_INTERVALS:
+        cmd.setdefault('minInterval', ADAPTIVE_INTERVALS[cmd['interval']][0])
+        cmd.setdefault('maxInterval', ADAPTIVE_INTERVALS[cmd['interval']][1])
+        if cmd.get('unit') == '℃':
+            cmd.setdefault('step', 0.5)
+    if cmd.get('unit') == '℃':
+        cmd.setdefault('deadband', 0.2)
+
+JSON_NAME_TABLE = str.maketrans({' ':'_', '-':'_', '.':None, 'ä':'ae', 'Ä':'Ae', 'ö':'oe', 'Ö':'Oe', 'ü':'ue', 'Ü':'Ue', 'ß':'ss', '(':None, ')':None})
+
+def historySlots(cmd):
+    # the entries of an error history as datapoints of their own, for polling them without ERROR_HISTORY
+    slots = []
+    for slot in range(cmd['history']):
+        entry = dict(cmd, addr=cmd['addr'] + cmd['size'] * slot, interval=POLL_SLOW, name='%s %d' % (cmd['name'], slot))
+        del entry['history']
+        slots.append(entry)
+    return slots
+
+def compileDatapoints(cmds):
+    # turns the readCmds into Datapoints with their decoder and JSON formatter bound
+    if not ERROR_HISTORY:
+        cmds = [entry for cmd in cmds for entry in (historySlots(cmd) if 'history' in cmd else [cmd])]
+    datapoints = []
+    for cmd in cmds:
+        jsonname = cmd['name'].translate(JSON_NAME_TABLE)
+        if 'conv' in cmd:
+            decode = functools.partial(eventTypeConversionFunctions[cmd['conv']], offset=cmd.get('offset', 0))
+        else:
+            decode = rawValue
+        if 'conv' not in cmd or cmd['name']=='ID' or cmd['name'].startswith('Schaltzeiten') or cmd['name']=='Datum und Uhrzeit':
+            fields = (lambda value, key=jsonname: [(key, '"%s"' % value)])
+        elif cmd['name']=='Solarertrag':
+            fields = (lambda value, key=jsonname, weekKey=jsonname + '_Woche': [(key, value.split(';',1)[0]), (weekKey, '[%s]' % ', '.join(value.split(';')))])
+        else:
+            fields = (lambda value, key=jsonname: [(key, value)])
+        encode = None
+        if cmd.get('write') and cmd.get('offset', 0) == 0:
+            encode = functools.partial(encodeValue, cmd)
+        datapoints.append(Datapoint(cmd, jsonname, decode, fields, encode))
+    return datapoints
+
+def queueWrite(writes, writable, mqc, userdata, message):
+    # MQTT callback of set/<name>, queues the encoded value for pollLink
+    name = message.topic.rsplit('/', 1)[-1]
+    dp = writable.get(name)
+    if dp is None:
+        logging.warning('%s is not writable' % name)
+        return
+    try:
+        data = dp.encode(message.payload.decode().strip())
+    except (ValueError, OverflowError, struct.error) as e:
+        logging.warning('Invalid value %r for %s [%s]' % (message.payload, dp, e))
+        return
+    try:
+        writes.put_nowait((dp, data, time.monotonic()))
+    except asyncio.QueueFull:
+        logging.warning('Too many writes waiting, dropping %s' % dp)
+
+async def sendRequest(session, msg, metrics=registry):
+    # sends msg up to READ_TRIES times, returns the reply or None
+    addr = '0x%04x' % msg.ADDR
+    for attempt in range(READ_TRIES):
+        if attempt:
+            metrics.inc('optolink_retries_total', addr=addr)
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        rmsg = await session.send(msg, attempt)
+        if rmsg:
+            return rmsg
+    return None
+
+async def writeDatapoint(session, dp, data, queued, publisher, metrics=registry):
+    # writes the datapoint, reads it back and publishes it, returns its fields or None on failure
+    addr = '0x%04x' % dp.addr
+    msg = VS2Message(ProtocolIdentifier.LDAP, MessageIdentifier.RequestMessage, FunctionCodes.Virtual_WRITE, dp.addr, dp.size, data)
+    with tracer.span('write ' + addr, size=dp.size) if tracer.enabled else NULL_SPAN:
+        rmsg = await sendRequest(session, msg, metrics)
+    if not rmsg or rmsg.identifier != MessageIdentifier.ResponseMessage:
+        logging.warning('Writing %s failed%s' % (dp, ' with ' + rmsg.identifier.name if rmsg else ''))
+        metrics.inc('optolink_writes_total', addr=addr, result='failed')
+        return None
+    metrics.inc('optolink_writes_total', addr=addr, result='ok')
+    with tracer.span('read ' + addr, size=dp.size) if tracer.enabled else NULL_SPAN:
+        rmsg = await sendRequest(session, requestMessage(FunctionCodes.Virtual_READ, dp.addr, dp.size), metrics)
+    if not rmsg or rmsg.identifier != MessageIdentifier.ResponseMessage:
+        logging.warning('Reading back %s failed' % dp)
+        return None
+    value = dp.decode(rmsg.Data)
+    logging.info('%s set to %s%s', dp, value, dp.unitSuffix)
+    fields = dp.fields(value)
+    if PUBLISH_TOPICS:
+        for jsonname,jsonvalue in fields:
+            publisher.publish(jsonname, jsonvalue, force=True) # the confirmation, even if the value did not change
+    metrics.observe('optolink_write_seconds', time.monotonic() - queued, addr=addr)
+    return fields
+
+async def readErrorHistory(session, dp, history, mqc, topic, metrics=registry):
+    # reads the whole ring of an error history, publishes it and the new faults
+    size = history.slots * history.size
+    with tracer.span('read history 0x%04x' % history.addr, size=size) if tracer.enabled else NULL_SPAN:
+        rmsg = await sendRequest(session, requestMessage(FunctionCodes.Virtual_READ, history.addr, size), metrics)
+    if not rmsg or rmsg.identifier != MessageIdentifier.ResponseMessage:
+        logging.warning('Reading the error history of %s failed' % dp)
+        return # watch() tells to read it again with the next poll
+    entries, new = history.update(rmsg.Data)
+    mqc.publish(topic + 'history/' + dp.jsonname, json.dumps(entries, ensure_ascii=False), qos=0, retain=True)
+    for entry in new:
+        logging.warning('New fault %s: %s' % (dp.name, entry))
+        mqc.publish(topic + 'events/' + dp.jsonname, json.dumps(entry, ensure_ascii=False), qos=1, retain=False)
+
+async def pollLink(session, datapoints, mqc, topic, metrics=registry, writes=None):
+    # reads the datapoints over the session when they are due and publishes them to topic,
+    # the (datapoint, data, time queued) entries of the writes queue go first
+    readPlan = planReads(datapoints, maxBlockSize=MAX_BLOCK_SIZE, maxGap=MAX_BLOCK_GAP)
+    logging.info('%d datapoints are read with %d requests' % (len(datapoints), len(readPlan)))
+    scheduler = PollScheduler(readPlan)
+    publisher = ChangePublisher(mqc, topic + 'status/', refresh=PUBLISH_REFRESH)
+    results = {}
+    changed = False
+    cycleStart = None
+    histories = {dp: ErrorHistory(dp.addr, dp.history, dp.size, errorEntry, HISTORY_REFRESH) for dp in datapoints if dp.history}
+    errorIndex = None # bytes at ERROR_INDEX_ADDR
+    if writes is None:
+        writes = asyncio.Queue()
+    write = None
+    while True:
+        if not session.started:
+            with tracer.span('handshake') if tracer.enabled else NULL_SPAN as span:
+                span.set('result', await session.start())
+            if not session.started:
+                continue
+        if write is None and not writes.empty():
+            write = writes.get_nowait()
+        if write:
+            dp = write[0]
+            fields = await writeDatapoint(session, *write, publisher, metrics)
+            write = None
+            if fields and results.get(dp) != fields:
+                results[dp] = fields
+                changed = True
+            continue
+        wait = scheduler.waitTime()
+        if wait > 0: # all due datapoints are read, publish them and wait for the next one
+            if cycleStart is not None:
+                metrics.observe('optolink_cycle_seconds', time.monotonic() - cycleStart, buckets=CYCLE_BUCKETS)
+                if tracer.enabled:
+                    tracer.complete('cycle', cycleStart, time.monotonic())
+                cycleStart = None
+            if changed and PUBLISH_JSON:
+                with tracer.span('publish json') if tracer.enabled else NULL_SPAN:
+                    resultJSON = '{'
+                    for dp in datapoints:
+                        for jsonname,jsonvalue in results.get(dp, ()):
+                            resultJSON += '"%s":%s,' % (jsonname,jsonvalue)
+                    resultJSON = resultJSON[:-1] + '}'
+                    mqc.publish(topic + 'status/json',resultJSON,qos=0,retain=True)
+            changed = False
+            if tracer.enabled:
+                tracer.flush()
+            try: # till the next datapoint is due or a write is queued
+                write = await asyncio.wait_for(writes.get(), wait)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        if cycleStart is None:
+            cycleStart = time.monotonic()
+        metrics.set('optolink_queue_depth', scheduler.overdue())
+        block = scheduler.pop()
+        msg = requestMessage(block.fc, block.addr, block.size)
+        addr = '0x%04x' % block.addr
+        # the span arguments are only built while tracing
+        with tracer.span('read ' + addr, size=block.size) if tracer.enabled else NULL_SPAN as span:
+            for attempt in range(1 if block.probeInterval else READ_TRIES): # a single try to probe a broken block
+                if attempt:
+                    metrics.inc('optolink_retries_total', addr=addr)
+                    await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+                rmsg = await session.send(msg, attempt)
+                if rmsg:
+                    break
+            else:
+                metrics.inc('optolink_failed_reads_total', addr=addr)
+            span.set('tries', attempt + 1)
+        if rmsg and rmsg.identifier != MessageIdentifier.ResponseMessage:
+            logging.warning('%s for %s' % (rmsg.identifier.name, block))
+            if block.merged(): # the unit might not allow the merged read, split it up
+                logging.warning('Splitting up read block %s' % block)
+                for single in splitBlock([block], block):
+                    scheduler.schedule(single, time.monotonic())
+                continue
+        if not rmsg or rmsg.identifier != MessageIdentifier.ResponseMessage: # ignore, if no success
+            if block.failed():
+                logging.warning('Suspending %s, probing it every %ds' % (block, block.probeInterval))
+                metrics.inc('optolink_circuit_opened_total', addr=addr)
+            scheduler.reschedule(block)
+            metrics.set('optolink_open_circuits', scheduler.broken())
+            continue
+        if block.probeInterval:
+            logging.info('Resuming %s' % block)
+            metrics.set('optolink_open_circuits', scheduler.broken()) # without this block, it is popped
+        block.succeeded()
+        data = rmsg.Data # a view into the reply, only valid till the next request
+        values = []
+        decoded = []
+        with tracer.span('decode') if tracer.enabled else NULL_SPAN:
+            for dp in block.cmds:
+                value = dp.decode(block.slice(data, dp))
+                logging.info('%s - %s%s', dp, value, dp.unitSuffix)
+                values.append((dp, value))
+                decoded.append((dp, dp.fields(value)))
+        with tracer.span('publish') if tracer.enabled else NULL_SPAN:
+            for dp, fields in decoded:
+                if PUBLISH_TOPICS:
+                    for jsonname,jsonvalue in fields:
+                        publisher.publish(jsonname, jsonvalue, dp.deadband)
+                if results.get(dp) != fields:
+                    results[dp] = fields
+                    changed = True
+        block.adapt(values, time.monotonic())
+        scheduler.reschedule(block)
+        # before the next request
+        for dp in block.cmds:
+            if dp.addr == ERROR_INDEX_ADDR and histories:
+                index = bytes(block.slice(data, dp))
+                if errorIndex is not None and index != errorIndex:
+                    for history in histories.values():
+                        history.invalidate()
+                errorIndex = index
+        changedHistories = [dp for dp in block.cmds if dp in histories and histories[dp].watch(block.slice(data, dp))]
+        for dp in changedHistories:
+            await readErrorHistory(session, dp, histories[dp], mqc, topic, metrics)
+
+async def superviseLink(link, mqc):
+    # polls one link and restarts it after errors, like a lost USB adapter
+    name = link['name']
+    topic = linkTopic(link)
+    metrics = registry.labelled(link=name)
+    tracer.setLane(name)
+    datapoints = compileDatapoints(link.get('readCmds', readCmds))
+    writes = asyncio.Queue(WRITE_QUEUE_SIZE)
+    mqc.message_callback_add(topic + 'set/+', functools.partial(queueWrite, writes, {dp.jsonname: dp for dp in datapoints if dp.encode}))
+    while True:
+        ser = None
+        keepalive = None
+        try:
+            # in the executor, for socket:// ports the connect blocks till it times out if the host is down
+            ser = await asyncio.get_running_loop().run_in_executor(None, functools.partial(serial.serial_for_url, link['port'], baudrate=4800, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_TWO, bytesize=serial.EIGHTBITS))
+            session = AsyncVS2Session(AsyncSerial(ser), metrics=metrics)
+            keepalive = asyncio.ensure_future(session.keepalive()) # keeps the session open while no datapoint is due
+            await pollLink(session, datapoints, mqc, topic, metrics, writes)
+        except Exception as e:
+            logging.error("Link %s failed [%s], restarting in %ds" % (name, e, LINK_RESTART_DELAY))
+            metrics.inc('optolink_link_restarts_total')
+        finally:
+            if keepalive:
+                keepalive.cancel()
+                try:
+                    await keepalive
+                except asyncio.CancelledError:
+                    pass
+                except Exception as e: # it died before, e.g. when the port failed while no datapoint was due
+                    logging.error("Keepalive of link %s failed [%s]" % (name, e))
+            if ser:
+                ser.close()
+        await asyncio.sleep(LINK_RESTART_DELAY)
+
+async def publishMetrics(mqc):
+    while True:
+        await asyncio.sleep(METRICS_PUBLISH)
+        mqc.publish(MQTT_TOPIC + 'metrics', registry.json(), qos=0, retain=False)
+
+async def watchRelaunch():
+    while True:
+        checkRelaunch()
+        await asyncio.sleep(1)
+
+async def run():
+    if METRICS_PORT:
+        serveMetrics(METRICS_PORT)
+    if TRACE_FILE:
+        tracer.open(TRACE_FILE, maxBytes=TRACE_MAX_BYTES)
     mqc=mqtt.Client()
     mqc.username_pw_set(username=MQTT_USER,password=MQTT_PASSWORD)
     mqc.on_connect=connecthandler
     mqc.on_disconnect=disconnecthandler
     mqc.will_set(MQTT_TOPIC+"connected",False,qos=2,retain=True)
     mqc.disconnected =True
-    mqc.connect(MQTT_SERVER,1883,60)
-    mqc.loop_start()
-
-    while True:
-        if not commStarted:
-            commStarted = startCommunication()
-            if commStarted:
-                #print("### connectionn estabilished")
-                logging.info('### connectionn estabilished')
-        if commStarted:
-            resultJSON = '{'
-            for cmd in readCmds:
-                jsonname = cmd['name'].replace(' ','_').replace('-','_').replace('.','').replace('ä','ae').replace('Ä','Ae').replace('ö','oe').replace('Ö','Oe').replace('ü','ue').replace('Ü','Ue').replace('ß','ss').replace('(','').replace(')','')
-                if 'cmd' in cmd:
-                    fc = cmd['cmd']
-                else:
-                    fc = FunctionCodes.Virtual_READ
-                msg = VS2Message(ProtocolIdentifier.LDAP, MessageIdentifier.RequestMessage, fc, cmd['addr'], cmd['size'])
-                for _ in range(0,5): # 5 tries to read a parameter
-                    rmsg = sendVS2Message(msg)
-                    if rmsg:
-                        break
-                if not rmsg: # ignore, if no success
-                    continue
-                if rmsg.identifier != MessageIdentifier.ResponseMessage:
-                    print("RECEIVED %s" % rmsg)
-                    continue
-                if 'conv' in cmd:
-                    if 'offset' in cmd:
-                        offset = cmd['offset']
-                    else:
-                        offset = 0
-                    result = '%s' % eventTypeConversionFunctions[cmd['conv']](rmsg.Data, offset)
-                    if cmd['name']=='ID' or cmd['name'].startswith('Schaltzeiten') or cmd['name']=='Datum und Uhrzeit':
-                        resultJSON += '"%s":"%s",' % (jsonname,result)
-                    elif cmd['name']=='Solarertrag':
-                        resultJSON += '"%s":%s,' % (jsonname,result.split(';',1)[0])
-                        resultJSON += '"%s_Woche":%s,' % (jsonname,('%s' % (result.split(';'))).replace("'",''))
-                    else:
-                        resultJSON += '"%s":%s,' % (jsonname,result)
-                else:
-                    result = '0x%s' % rmsg.Data.hex()
-                    if len(rmsg.Data) == 2:
-                        result += ' %d' % (rmsg.Data[0] + 256 * rmsg.Data[1])
-                    resultJSON += '"%s":"%s",' % (jsonname,result)
-                if 'unit' in cmd:
-                    result += ' ' + cmd['unit']
-                logging.info('%04x:%02x - %s - %s' % (cmd['addr'], cmd['size'], cmd['name'], result))
-            resultJSON = resultJSON[:-1] + '}'
-            mqc.publish(MQTT_TOPIC + 'status/json',resultJSON,qos=0,retain=True)
-            time.sleep(15)
-
-except Exception as e:
-    logging.error("Unhandled error [" + str(e) + "]")
-    sys.exit(1)
+    await AsyncMQTTClient(mqc).connect(MQTT_SERVER,1883,60)
+    tasks = [watchRelaunch()] + [superviseLink(link, mqc) for link in LINKS]
+    if METRICS_PUBLISH:
+        tasks.append(publishMetrics(mqc))
+    await asyncio.gather(*tasks)
+
+def main():
+    try:
+        asyncio.run(run())
+    except Exception as e:
+        logging.error("Unhandled error [" + str(e) + "]")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
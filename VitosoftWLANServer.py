@@ -5,19 +5,44 @@ import socket
 import sys
 import serial
 import time
-import binascii
+from VS2Protocol import DecoderEvent, VS2FrameDecoder, MessageIdentifier, VS2_DAP_STANDARD, MAX_FRAME_SIZE, RESPONSE_TIMEOUT, INTER_BYTE_TIMEOUT, readBytes, startCommunication
 
 # This script can run on e.g. a Raspberry Pi that is configured to be configured as a WLAN
 # access point, while the Ethernet port is configured as a started network port.
 
 # It is just an example and does not work reliably. Feel free to improve it.
 
+def forwardReply(ser, decoder, data):
+    # collects the reply of the unit to data, returns as soon as it is complete
+    if data == b'\x06': # VS2_ACK for a received frame, the unit does not answer it
+        return bytes()
+    expectFrame = data[0] == VS2_DAP_STANDARD and len(data) > 2 and (data[2] & 0x0F) == MessageIdentifier.RequestMessage
+    decoder.reset()
+    out = bytearray()
+    deadline = time.monotonic() + RESPONSE_TIMEOUT
+    while True:
+        buf = readBytes(ser, decoder.missing(), deadline, INTER_BYTE_TIMEOUT if decoder.inFrame() else None)
+        if not len(buf):
+            return out
+        for event, frame in decoder.feed(buf):
+            if event == DecoderEvent.FRAME:
+                out += frame
+                return out
+            elif event == DecoderEvent.ENQ:
+                out.append(0x05)
+            elif event == DecoderEvent.ACK:
+                out.append(0x06)
+            elif event == DecoderEvent.NACK:
+                out.append(0x15)
+            if not expectFrame or event == DecoderEvent.NACK:
+                return out
+
 # Create a TCP/IP socket
 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 # Bind the socket to the port
 server_address = ('10.45.161.1', 45317)
-print >>sys.stderr, 'starting up on %s:%s' % server_address
+print('starting up on %s:%s' % server_address, file=sys.stderr)
 sock.bind(server_address)
 
 # Listen for incoming connections
@@ -30,39 +55,33 @@ ser = serial.Serial(
     stopbits=serial.STOPBITS_TWO,
     bytesize=serial.EIGHTBITS
 )
+decoder = VS2FrameDecoder()
 
 print("SEND EOT")
-ser.write(binascii.unhexlify('04'))
-if ser.read(1)==binascii.unhexlify('05'):
-  ser.write(binascii.unhexlify('160000'))
-  print(binascii.hexlify(ser.read(1)))
+startCommunication(ser, decoder=decoder)
 print("START")
 
 while True:
     # Wait for a connection
-    print >>sys.stderr, 'waiting for a connection'
+    print('waiting for a connection', file=sys.stderr)
     connection, client_address = sock.accept()
 
     try:
-        print >>sys.stderr, 'connection from', client_address
+        print('connection from', client_address, file=sys.stderr)
 
         while True:
-            data = connection.recv(8)
-            print >>sys.stderr, 'OptoLink > %s' % " ".join("{:02x}".format(ord(c)) for c in data)
+            data = connection.recv(MAX_FRAME_SIZE)
+            print('OptoLink > %s' % data.hex(' '), file=sys.stderr)
             if data:
-#                print >>sys.stderr, 'serial send'
+#                print('serial send', file=sys.stderr)
                 ser.write(data)
-#                print >>sys.stderr, 'serial wait'
-                time.sleep(1/(4800/12)*1.2)
-                out = ''
-                while ser.in_waiting > 0:
-                    out += ser.read(1)
-                    time.sleep(1/(4800/12)*1.2)
-                if out != '':
-                    print >>sys.stderr, 'OptoLink < %s' % " ".join("{:02x}".format(ord(c)) for c in out)
+#                print('serial wait', file=sys.stderr)
+                out = forwardReply(ser, decoder, data)
+                if len(out):
+                    print('OptoLink < %s' % out.hex(' '), file=sys.stderr)
                     connection.sendall(out)
             else:
-                print >>sys.stderr, 'no more data from', client_address
+                print('no more data from', client_address, file=sys.stderr)
                 break
     finally:
         # Clean up the connection
@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import binascii
+import hashlib
+import html
+import json
 import logging
 import logging.handlers
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
+import queue
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Thread
+from urllib.parse import urlencode, urlsplit
 
 import paho.mqtt.client as mqtt
 import serial
 
+from MQTTPublisher import ChangePublisher
+from OptolinkAsync import AsyncMQTTClient, AsyncSerial, openSession
+
 logging.getLogger().setLevel('DEBUG')
 logging.info('Starting Viessmann2mqtt')
 
@@ -19,6 +29,29 @@ MQTT_SERVER = '7.73.129.85'
 MQTT_TOPIC = 'Viessmann/'  # should end with /
 hostName = ""
 serverPort = 443
+SERIAL_PORT = '/dev/ttyUSB0'  # or socket://host:port, e.g. for the OptolinkSimulator.py
+
+# After every sweep the state of all stat_commands is published as one JSON object to status/json.
+# With PUBLISH_TOPICS, every command is also published to status/<name> (retained), only when its value changed.
+PUBLISH_TOPICS = True
+
+# The stat_commands are read every POLL_INTERVAL seconds. The VS1 session stays open in between,
+# kept alive with a read every 500ms, and is only synced again after an error.
+POLL_INTERVAL = 5
+
+# Neighbouring stat_commands are read with one request of up to MAX_BLOCK_LENGTH bytes. Gaps of up to
+# MAX_BLOCK_GAP bytes between two of them are read over, but only within READABLE_RANGES, the address
+# ranges which are known to be readable as a whole. A merged read which fails SPLIT_THRESHOLD times in
+# a row while the single reads succeed is split up: its commands are read one by one for
+# SPLIT_INTERVAL seconds, then the merged read is tried again. The interval doubles with every merged
+# read which fails again, up to SPLIT_MAX_INTERVAL. VS1 has no error replies, a single failed read
+# can also be a glitch on the bus.
+MAX_BLOCK_LENGTH = 32
+MAX_BLOCK_GAP = 4
+READABLE_RANGES = [(0x2300, 0x2310)]  # operating mode, party mode and room setpoints of M1
+SPLIT_THRESHOLD = 3
+SPLIT_INTERVAL = 300
+SPLIT_MAX_INTERVAL = 3600
 
 CMD_VREAD = binascii.unhexlify('F7')
 CMD_VWRITE = binascii.unhexlify('F4')
@@ -31,7 +64,35 @@ STYLE = '''
     }
 '''
 
-WRITE_COMMAND = None
+# Writes requested over HTTP wait in writeQueue and are sent between two reads, all waiting ones
+# within the same VS1 session. The result is published to MQTT_TOPIC + 'write/<path>' and the HTTP
+# request waits up to WRITE_ACK_TIMEOUT seconds for it.
+# The HTTP server serves the state of the last sweep from a snapshot, as page on /, as JSON on
+# /api/state and pushes it as Server-Sent Events on /api/events whenever it changed. Idle event
+# streams get a comment every SSE_PING_INTERVAL seconds.
+SSE_PING_INTERVAL = 15
+
+WRITE_QUEUE_SIZE = 8
+WRITE_ACK_TIMEOUT = 10
+
+writeQueue = queue.Queue(WRITE_QUEUE_SIZE)
+writeQueued = None # asyncio.Event, set when a write was queued
+eventLoop = None
+
+
+def queueWrite(request):
+    # called by the HTTP server thread, raises queue.Full
+    writeQueue.put_nowait(request)
+    if eventLoop:
+        eventLoop.call_soon_threadsafe(writeQueued.set)
+
+
+class WriteRequest:
+    def __init__(self, path, cmd):
+        self.path = path
+        self.cmd = cmd
+        self.result = 'queued'
+        self.done = Event()
 
 
 def connecthandler(mqc, userdata, flags, rc):
@@ -43,39 +104,116 @@ def disconnecthandler(mqc, userdata, rc):
     logging.warning("Disconnected from MQTT broker with rc=%d" % rc)
 
 
+class Snapshot:
+    # the rendered state of the commands, never changed after it was built
+    def __init__(self, commands):
+        self.state = {cmd.name: cmd.res for cmd in commands}
+        self.json = json.dumps(self.state).encode()
+        self.html = renderPage(commands).encode()
+        self.etag = '"%s"' % hashlib.sha1(self.json).hexdigest()[:16]
+
+
+snapshot = None # the current Snapshot, replaced as a whole by updateSnapshot()
+snapshotChanged = Condition()
+
+
+def updateSnapshot(commands):
+    global snapshot
+    if snapshot is not None and snapshot.state == {cmd.name: cmd.res for cmd in commands}:
+        return
+    with snapshotChanged:
+        snapshot = Snapshot(commands)
+        snapshotChanged.notify_all()
+
+
+def renderPage(commands):
+    # the values are updated by the events of /api/events, the result of a write is in the query
+    return ("<html>"
+            "<head>"
+            "<title>KW1</title>"
+            "<style>%s</style>"
+            "</head>\n"
+            "<body>\n"
+            "<p id='request'></p>\n"
+            "<div>Partymodus <a href='/party_on'>AN</a>|<a href='/party_off'>AUS</a></div>\n"
+            "<div>Modus <a href='/mod_ww'>Warm Wasser</a>|<a href='/mod_all'>Alles An</a></div>\n"
+            "%s"
+            "<script>\n"
+            "if (location.search) document.getElementById('request').textContent = 'Request: ' + decodeURIComponent(location.search.substring(1));\n"
+            "new EventSource('/api/events').addEventListener('state', function(event) {\n"
+            "    var state = JSON.parse(event.data);\n"
+            "    for (var name in state) { var span = document.getElementById(name); if (span) span.textContent = state[name]; }\n"
+            "});\n"
+            "</script>\n"
+            "</body></html>\n" % (STYLE, ''.join("<div>%s: <span id='%s'>%s</span></div>\n" % (html.escape(cmd.desc), cmd.name, html.escape(str(cmd.res))) for cmd in commands)))
+
+
 class MyServer(BaseHTTPRequestHandler):
     def do_GET(self):
-        global WRITE_COMMAND
-
-        if self.path != '/':
+        path = urlsplit(self.path).path
+        if path == '/':
+            current = snapshot
+            self.sendSnapshot(current.html, "text/html; charset=utf-8", current.etag)
+        elif path == '/api/state':
+            current = snapshot
+            self.sendSnapshot(current.json, "application/json", current.etag)
+        elif path == '/api/events':
+            self.sendEvents()
+        elif self.path in write_commands:
+            request = WriteRequest(self.path, write_commands[self.path])
             try:
-                WRITE_COMMAND = write_commands[self.path]
-            except:
-                pass
+                queueWrite(request)
+            except queue.Full:
+                request.result = 'busy'
+            else:
+                request.done.wait(WRITE_ACK_TIMEOUT)
+            self.send_response(303)
+            self.send_header("Location", "/?" + urlencode({'write': self.path[1:], 'result': request.result}))
+            self.end_headers()
+        else:
             self.send_response(307)
             self.send_header("Location", "/")
             self.end_headers()
-        else:
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
+
+    def sendSnapshot(self, body, contentType, etag):
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
             self.end_headers()
-            self.wfile.write(bytes("<html>"
-                                   "<head>"
-                                   "<title>KW1</title>"
-                                   "<meta http-equiv='refresh' content='30'>"
-                                   "<style>%s</style>"
-                                   "</head>\n" % STYLE, "utf-8"))
-            self.wfile.write(bytes("<p>Request: %s</p>\n" % self.path, "utf-8"))
-            self.wfile.write(bytes("<body>\n", "utf-8"))
-            self.wfile.write(bytes("<div>Partymodus <a href='/party_on'>AN</a>|<a href='/party_off'>AUS</a></div>\n", "utf-8"))
-            self.wfile.write(bytes("<div>Modus <a href='/mod_ww'>Warm Wasser</a>|<a href='/mod_all'>Alles An</a></div>\n", "utf-8"))
-            for cmd in stat_commands:
-                self.wfile.write(bytes("<div>%s: <span>%s</span></div>\n" % (cmd.desc, cmd.res), "utf-8"))
-            self.wfile.write(bytes("</body></html>\n", "utf-8"))
+            return
+        self.send_response(200)
+        self.send_header("Content-type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendEvents(self):
+        # sends the state and then every new snapshot, till the client disconnects
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        sent = None
+        try:
+            while True:
+                with snapshotChanged:
+                    if snapshot is sent:
+                        snapshotChanged.wait(SSE_PING_INTERVAL)
+                    current = snapshot
+                if current is sent:
+                    self.wfile.write(b": ping\n\n")
+                else:
+                    self.wfile.write(b"event: state\ndata: " + current.json + b"\n\n")
+                    sent = current
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
 
 
 def startServer():
-    webServer = HTTPServer((hostName, serverPort), MyServer)
+    webServer = ThreadingHTTPServer((hostName, serverPort), MyServer)
     print("Server started http://%s:%s" % (hostName, serverPort))
     webServer.serve_forever()
 
@@ -90,9 +228,16 @@ def main():
 
 
 def startLoop():
+    asyncio.run(runLoop())
+
+
+async def runLoop():
+    global eventLoop, writeQueued
+    eventLoop = asyncio.get_running_loop()
+    writeQueued = asyncio.Event()
     print("Connecting...")
-    ser = serial.Serial(
-        port='/dev/ttyUSB0',
+    ser = serial.serial_for_url(
+        SERIAL_PORT,
         baudrate=4800,
         parity=serial.PARITY_EVEN,
         stopbits=serial.STOPBITS_TWO,
@@ -100,70 +245,129 @@ def startLoop():
         xonxoff=False,
         exclusive=True
     )
+    port = AsyncSerial(ser)
     mqc = mqtt.Client()
     mqc.username_pw_set(username=MQTT_USER, password=MQTT_PASSWORD)
     mqc.on_connect = connecthandler
     mqc.on_disconnect = disconnecthandler
     mqc.will_set(MQTT_TOPIC + "connected", False, qos=2, retain=True)
     mqc.disconnected = True
-    mqc.connect(MQTT_SERVER, 1883, 60)
-    mqc.loop_start()
+    await AsyncMQTTClient(mqc).connect(MQTT_SERVER, 1883, 60)
+    # only on change, without a periodic refresh, the topics are retained for late subscribers
+    publisher = ChangePublisher(mqc, MQTT_TOPIC + 'status/', refresh=float('inf')) if PUBLISH_TOPICS else None
     print("Connected")
 
-    while True:
-        loop(ser, stat_commands, mqc)
-        ser.timeout = 5
-        ser.read(100)
+    # VS2, if the unit supports it, it has checksums and tells about unknown addresses
+    session = await openSession(port)
+    while session is None:
+        print("Waiting for ENQ")
+        session = await openSession(port)
+    keepalive = asyncio.ensure_future(session.keepalive()) # kept, the event loop only holds a weak reference
+    plan = planReads(stat_commands)
+    print("%d commands are read with %d requests" % (len(stat_commands), len(plan)))
+    try:
+        while True:
+            start = time.monotonic()
+            await loop(session, stat_commands, mqc, publisher, plan)
+            # till the next sweep, the writes are sent as soon as they are queued
+            while True:
+                writeQueued.clear()
+                if writeQueue.empty():
+                    try:
+                        await asyncio.wait_for(writeQueued.wait(), start + POLL_INTERVAL - time.monotonic())
+                    except asyncio.TimeoutError:
+                        break
+                try:
+                    await writePending(session, mqc)
+                except Exception as e:
+                    logging.error("Unhandled error serial [" + str(e) + "]")
+    finally:
+        keepalive.cancel()
+        try:
+            await keepalive
+        except asyncio.CancelledError:
+            pass
+        except Exception as e: # it died before, e.g. when the port failed between two sweeps
+            logging.error("Keepalive failed [" + str(e) + "]")
     # print("Done!")
 
 
-def loop(ser, commands, mqc):
-    global WRITE_COMMAND
-    print("Waiting for ACK")
-    ser.timeout = 3
-
+async def loop(session, commands, mqc, publisher=None, plan=None):
+    # plan are the ReadBlocks of the commands, the commands of split up ones are read one by one
+    if plan is None:
+        plan = planReads(commands)
     try:
-        if ser.read(1) == binascii.unhexlify('05'):
-            # print("Got ACK")
-            ser.write(binascii.unhexlify('01'))
-            for cmd in commands:
-                command(ser, cmd)
-            if WRITE_COMMAND is not None:
-                command(ser, WRITE_COMMAND)
-                WRITE_COMMAND = None
+        # the reads sync the session, if it is not open
+        for block in plan:
+            await writePending(session, mqc)
+            if len(block.cmds) == 1:
+                await readBlock(session, block)
+                continue
+            now = time.monotonic()
+            if now >= block.splitUntil:
+                if await readBlock(session, block):
+                    if block.splitInterval:
+                        logging.info("Merging read block 0x%04x %d again" % (block.addr, block.length))
+                    block.mergedSucceeded()
+                    continue
+            results = [await readBlock(session, single) for single in block.singles()]
+            if now >= block.splitUntil and all(results) and block.mergedFailed(now):
+                logging.warning("Splitting up read block 0x%04x %d for %ds" % (block.addr, block.length, block.splitInterval))
+        await writePending(session, mqc)
+        updateSnapshot(commands)
     except Exception as e:
         logging.error("Unhandled error serial [" + str(e) + "]")
 
     try:
-        print('Sending metrics')
-
-        for cmd in commands:
-            resultJSON = '{"' + cmd.name + '":"' + str(cmd.res) + '"}'
-            mqc.publish(MQTT_TOPIC + 'status/json', resultJSON, qos=0, retain=True)
+        # publish() only queues the messages, the MQTT client sends them when the socket is writable
+        mqc.publish(MQTT_TOPIC + 'status/json', snapshot.json, qos=0, retain=True)
+        if publisher:
+            for cmd in commands:
+                publisher.publish(cmd.name, str(cmd.res))
     except Exception as e:
         logging.error("Unhandled error mqtt [" + str(e) + "]")
 
 
-def command(ser, cmd):
+async def writePending(session, mqc):
+    # sends the queued writes and acknowledges them over MQTT and to the waiting HTTP request
+    while True:
+        try:
+            request = writeQueue.get_nowait()
+        except queue.Empty:
+            return
+        request.result = 'ok' if await command(session, request.cmd) else 'failed'
+        logging.info('Write %s %s' % (request.path, request.result))
+        mqc.publish(MQTT_TOPIC + 'write' + request.path, json.dumps({'name': request.cmd.name, 'value': request.cmd.res[:request.cmd.length].hex(), 'result': request.result}), qos=1, retain=False)
+        request.done.set()
+
+
+async def readBlock(session, block):
+    # reads the block and converts the values of its commands, returns False if the read failed
+    val = await session.read(block.addr, block.length)
+    # print('OptoLink < %s' % binascii.hexlify(val))
+    if len(val) != block.length:
+        return False # keep the last values
+    for cmd in block.cmds:
+        data = block.slice(val, cmd)
+        result = cmd.decode(data)
+        cmd.res = ConversionError(cmd.unit, data) if result is None else result
+        # print('Command %s returned %s' % (cmd.name, cmd.res))
+    return True
+
+
+async def command(session, cmd):
+    # returns False if the read or write failed
     # print("Execute command", cmd.name)
-    ser.write(cmd.protocmd)
-    # print("Proto", cmd.protocmd)
-    ser.write(cmd.address)
-    # print("Address", cmd.address)
-    ser.write(cmd.length.to_bytes(1, 'big'))
-    ser.timeout = 1
     if cmd.protocmd == CMD_VREAD:
-        # print("Now reading", cmd.length)
-        val = ser.read(cmd.length)
-        # print('OptoLink < %s' % binascii.hexlify(val))
-        cmd.res = convertunit(cmd.unit, val)
-        # print('Command %s returned %s' % (cmd.name, cmd.res))
+        return await readBlock(session, ReadBlock(cmd))
     elif cmd.protocmd == CMD_VWRITE:
-        ser.write(cmd.res)
-        if ser.read(1) == binascii.unhexlify('00'):
+        # only cmd.length bytes, the unit would take the rest as the next request
+        if await session.write(cmd.addr, cmd.res[:cmd.length]):
             pass # print('Command %s wrote %s' % (cmd.name, cmd.res))
         else:
-            pass # print('Error in write command %s %s' % (cmd.name, cmd.res))
+            # print('Error in write command %s %s' % (cmd.name, cmd.res))
+            return False
+    return True
 
 
 def errorcode(errorcode):
@@ -284,35 +488,96 @@ def errorcode(errorcode):
     return 'errorcode_%02x' % errorcode
 
 
-# STate ReTurnstatus COunter CS/3600
+# Units of the commands: UT temperature in 1/10 degrees, ST setpoint, RT return status, CO counter,
+# CS seconds (shown in hours), BA operating mode and deviceType, looked up in DEVICE_TYPES and
+# OPERATING_MODES. UNIT_CODECS has the decoder from the bytes read and the encoder for writes of
+# every unit. Every Command has the decoder of its unit and length bound, so the reads convert with a
+# single call.
+
+DEVICE_TYPES = {0x9420: 'V200 KW1'}  # the 2 bytes of 0x00F8 as little endian value
+OPERATING_MODES = {
+    0x00: 'Warm Wasser',
+    0x01: 'Reduziert',
+    0x02: 'Normal',
+    0x03: 'Heizung und Warm Wasser',
+    0x04: 'Heizung und Warmwasser',
+    0x05: 'Abgeschaltet',
+}
+
+
+class ConversionError(str):
+    # the result of values which can't be converted, a str 'error' like before, with the unit and bytes
+    def __new__(cls, unit, value):
+        self = super().__new__(cls, 'error')
+        self.unit = unit
+        self.value = bytes(value)
+        return self
+
+
+class UnitCodec:
+    __slots__ = ('decode', 'encode')
+
+    def __init__(self, decode, encode):
+        self.decode = decode  # bytes to value, None if the bytes can't be converted
+        self.encode = encode  # value and length to bytes, raises ValueError
+
+    def decoder(self, length):
+        # the decoder for values of length bytes, single bytes are looked up in a table
+        if length == 1:
+            return {bytes((i,)): self.decode(bytes((i,))) for i in range(256)}.get
+        return self.decode
+
+
+def numberCodec(scale=1, signed=False):
+    if scale == 1:
+        decode = (lambda value: int.from_bytes(value, 'little', signed=signed))
+    else:
+        decode = (lambda value: int.from_bytes(value, 'little', signed=signed) / scale)
+
+    def encode(value, length):
+        try:
+            return round(float(value) * scale).to_bytes(length, 'little', signed=signed)
+        except OverflowError:
+            raise ValueError('%s does not fit into %d bytes' % (value, length))
+    return UnitCodec(decode, encode)
+
+
+def enumCodec(table, length):
+    # the names are looked up by the bytes read, without converting them to a number first
+    byBytes = {code.to_bytes(length, 'little'): name for code, name in table.items()}
+    byName = {name: code for code, name in table.items()}
+
+    def encode(value, length):
+        code = byName[value] if value in byName else int(value)
+        if code not in table:
+            raise ValueError('%s is not one of %s' % (value, ', '.join(byName)))
+        return code.to_bytes(length, 'little')
+    return UnitCodec(byBytes.get, encode)
+
+
+UNIT_CODECS = {
+    'deviceType': enumCodec(DEVICE_TYPES, 2),
+    'UT': numberCodec(10, signed=True),
+    'ST': numberCodec(),
+    'RT': numberCodec(),
+    'CO': numberCodec(),
+    'CS': numberCodec(3600),
+    'BA': enumCodec(OPERATING_MODES, 1),
+}
+
+
+def noDecoder(value):
+    return None
+
+
 def convertunit(unit, value):
-    if unit == 'deviceType':
-        if value == binascii.unhexlify('2094'):
-            return 'V200 KW1'
-    if unit == 'UT':
-        return int.from_bytes(value, "little", signed=True) / 10
-    if unit == 'ST':
-        return int.from_bytes(value, "little")
-    if unit == 'RT':
-        return int.from_bytes(value, "little")
-    if unit == 'CO':
-        return int.from_bytes(value, "little")
-    if unit == 'CS':
-        return int.from_bytes(value, "little") / 3600
-    if unit == 'BA':
-        if value == binascii.unhexlify('00'):
-            return 'Warm Wasser'
-        if value == binascii.unhexlify('01'):
-            return 'Reduziert'
-        if value == binascii.unhexlify('02'):
-            return 'Normal'
-        if value == binascii.unhexlify('03'):
-            return 'Heizung und Warm Wasser'
-        if value == binascii.unhexlify('04'):
-            return 'Heizung und Warmwasser'
-        if value == binascii.unhexlify('05'):
-            return 'Abgeschaltet'
-    return 'error'
+    result = UNIT_CODECS[unit].decode(value) if unit in UNIT_CODECS else None
+    return ConversionError(unit, value) if result is None else result
+
+
+def encodeunit(unit, value, length):
+    # the bytes to write for the value, raises ValueError if it can't be encoded
+    return UNIT_CODECS[unit].encode(value, length)
 
 
 class Command:
@@ -320,21 +585,77 @@ class Command:
         self.name = name
         self.protocmd = protocmd
         self.address = binascii.unhexlify(address)
+        self.addr = int.from_bytes(self.address, 'big')
         self.length = length
         self.unit = unit
+        self.decode = UNIT_CODECS[unit].decoder(length) if unit in UNIT_CODECS else noDecoder
         self.desc = desc
         self.res = res
 
 
+class ReadBlock:
+    # one read request for one or more commands
+    def __init__(self, cmd):
+        self.addr = cmd.addr
+        self.length = cmd.length
+        self.cmds = [cmd]
+        self.failures = 0  # merged reads in a row which failed while the single reads succeeded
+        self.splitUntil = 0  # the commands are read one by one till then
+        self.splitInterval = 0  # > 0 while the block is split up
+        self.singleBlocks = None
+
+    def slice(self, data, cmd):
+        # the bytes of one command within the block
+        start = cmd.addr - self.addr
+        return data[start:start + cmd.length]
+
+    def singles(self):
+        # one block per command, to read them one by one
+        if self.singleBlocks is None:
+            self.singleBlocks = [ReadBlock(cmd) for cmd in self.cmds]
+        return self.singleBlocks
+
+    def mergedSucceeded(self):
+        self.failures = 0
+        self.splitInterval = 0
+
+    def mergedFailed(self, now):
+        # counts a failed merged read, returns True if the block is split up
+        self.failures += 1
+        if self.failures < SPLIT_THRESHOLD:
+            return False
+        self.splitInterval = min(2 * self.splitInterval, SPLIT_MAX_INTERVAL) if self.splitInterval else SPLIT_INTERVAL
+        self.splitUntil = now + self.splitInterval
+        return True
+
+
+def planReads(commands, maxLength=MAX_BLOCK_LENGTH, maxGap=MAX_BLOCK_GAP, readable=READABLE_RANGES):
+    # merges the reads of neighbouring commands into as few ReadBlocks as possible
+    blocks = []
+    block = None
+    for cmd in sorted((cmd for cmd in commands if cmd.protocmd == CMD_VREAD), key=lambda cmd: (cmd.addr, -cmd.length)):
+        if block:
+            end = block.addr + block.length
+            newEnd = max(end, cmd.addr + cmd.length)
+            gapReadable = cmd.addr <= end or any(start <= end and cmd.addr <= stop for start, stop in readable)
+            if cmd.addr <= end + maxGap and newEnd - block.addr <= maxLength and gapReadable:
+                block.length = newEnd - block.addr
+                block.cmds.append(cmd)
+                continue
+        block = ReadBlock(cmd)
+        blocks.append(block)
+    return blocks
+
+
 write_commands = {
-    "/party_on": Command("setBetriebPartyM1", CMD_VWRITE, '2303', 1, 'RT', 'Partymodus', binascii.unhexlify('01')),
-    "/party_off": Command("setBetriebPartyM1", CMD_VWRITE, '2303', 1, 'RT', 'Partymodus', binascii.unhexlify('00')),
-    "/mod_ww": Command("setBetriebsArt", CMD_VWRITE, '2301', 1, 'BA', 'Modus', binascii.unhexlify('00')),
-    "/mod_all": Command("setBetriebsArt", CMD_VWRITE, '2301', 1, 'BA', 'Modus', binascii.unhexlify('04')),
-    "/ww_60": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 60', int.to_bytes(60,2,"little")),
-    "/ww_55": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 55', int.to_bytes(55,2,"little")),
-    "/ww_50": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 50', int.to_bytes(50,2,"little")),
-    "/ww_45": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 45', int.to_bytes(45,2,"little")),
+    "/party_on": Command("setBetriebPartyM1", CMD_VWRITE, '2303', 1, 'RT', 'Partymodus', encodeunit('RT', 1, 1)),
+    "/party_off": Command("setBetriebPartyM1", CMD_VWRITE, '2303', 1, 'RT', 'Partymodus', encodeunit('RT', 0, 1)),
+    "/mod_ww": Command("setBetriebsArt", CMD_VWRITE, '2301', 1, 'BA', 'Modus', encodeunit('BA', 'Warm Wasser', 1)),
+    "/mod_all": Command("setBetriebsArt", CMD_VWRITE, '2301', 1, 'BA', 'Modus', encodeunit('BA', 'Heizung und Warmwasser', 1)),
+    "/ww_60": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 60', encodeunit('ST', 60, 1)),
+    "/ww_55": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 55', encodeunit('ST', 55, 1)),
+    "/ww_50": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 50', encodeunit('ST', 50, 1)),
+    "/ww_45": Command("setTempWWsoll", CMD_VWRITE, '6300', 1, 'ST', 'Warmwasser Soll 45', encodeunit('ST', 45, 1)),
 }
 
 stat_commands = [
@@ -370,4 +691,7 @@ stat_commands = [
 
 ]
 
-main()
+snapshot = Snapshot(stat_commands)
+
+if __name__ == '__main__':
+    main()